@@ -0,0 +1,560 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import List, Dict, Optional, Generator, Callable, Any, Tuple, Set
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import cache
+import timings
+from instances import ConnectionType, Instance, InstancesRepository
+
+
+class InstanceMetadataFetcher:
+    """Fetches the EC2 and SSM metadata for the instances in a region, at the same time, and merges them."""
+
+    def __init__(self, region: str, session: Optional[boto3.Session] = None, account_id: Optional[str] = None):
+        """
+        :param session: the session for the account to fetch from, instead of the current credentials
+        :param account_id: the AWS account the instances belong to, if it is known
+        """
+        self._logger = logging.getLogger(__name__)
+        self._region = region
+        self._account_id = account_id
+        self._clients = {
+            'EC2': create_client('ec2', region, session),
+            'SSM': create_client('ssm', region, session),
+        }
+
+    def fetch(self, on_instances: Optional[Callable[[List[Instance]], None]] = None) -> InstancesRepository:
+        """
+        Fetch every running instance. The SSM metadata is fetched at the same time as the EC2 metadata, which is merged
+        with it a page at a time.
+
+        :param on_instances: called with the instances from each page as soon as they have been fetched
+        """
+        started = time.perf_counter()
+        instances = []
+
+        if _transport.ssm_lookup == 'running_instances':
+            return self._fetch_with_ssm_metadata_for_each_page(on_instances, started)
+
+        ec2_seconds = 0.0
+        ssm_wait_seconds = 0.0
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{self._region}-ssm') as executor:
+            ssm_metadata = executor.submit(_run_timed, partial(SsmMetadataClient, self._clients['SSM']))
+            ec2_pages = fetch_ec2_metadata_pages(self._clients['EC2'])
+
+            while True:
+                page_started = time.perf_counter()
+                ec2_page = next(ec2_pages, None)
+                ec2_seconds += time.perf_counter() - page_started
+                if ec2_page is None:
+                    break
+
+                # Only the first page has to wait for SSM
+                wait_started = time.perf_counter()
+                page_ssm_metadata, _ = ssm_metadata.result()
+                ssm_wait_seconds += time.perf_counter() - wait_started
+
+                page_instances = list(self._merge_instance_metadata(ec2_page, page_ssm_metadata))
+                instances.extend(page_instances)
+
+                if on_instances is not None and page_instances:
+                    on_instances(page_instances)
+
+            _, ssm_seconds = ssm_metadata.result()
+
+        # Fetched one after another, EC2 would have been waited for as well as the whole of SSM, rather than only the
+        # part of SSM that hadn't finished when the first EC2 page arrived
+        self._logger.debug(f"Fetched {len(instances)} instances in {self._region} in "
+                           f"{time.perf_counter() - started:.2f}s (EC2 {ec2_seconds:.2f}s, SSM {ssm_seconds:.2f}s), "
+                           f"saving {ssm_seconds - ssm_wait_seconds:.2f}s over fetching them one after another")
+
+        return InstancesRepository(instances)
+
+    def _fetch_with_ssm_metadata_for_each_page(self, on_instances: Optional[Callable[[List[Instance]], None]],
+                                               started: float) -> InstancesRepository:
+        """
+        Fetch every running instance, asking SSM only about the running instances in each page of EC2 metadata. SSM
+        knows about every managed node, including on-premises servers and stopped instances, so this makes far fewer
+        requests when most of them aren't running EC2 instances.
+        """
+        instances = []
+
+        for ec2_page in fetch_ec2_metadata_pages(self._clients['EC2']):
+            instance_ids = [instance.instance_id for instance in ec2_page if instance.is_running()]
+            if not instance_ids:
+                continue
+
+            ssm_metadata = SsmMetadataClient(self._clients['SSM'], instance_ids)
+            page_instances = list(self._merge_instance_metadata(ec2_page, ssm_metadata))
+            instances.extend(page_instances)
+
+            if on_instances is not None:
+                on_instances(page_instances)
+
+        self._logger.debug(f"Fetched {len(instances)} instances in {self._region}, and the SSM metadata for only those "
+                           f"instances, in {time.perf_counter() - started:.2f}s")
+
+        return InstancesRepository(instances)
+
+    def fetch_running_by_instance_name(self, name: str) -> InstancesRepository:
+        """Fetch only the running instances with this name, rather than every instance."""
+        return self._fetch_matching(filters=[
+            {'Name': 'tag:Name', 'Values': [name]},
+            {'Name': 'instance-state-name', 'Values': ['running']},
+        ])
+
+    def fetch_running_by_instance_id(self, instance_id: str) -> InstancesRepository:
+        """Fetch only the instance with this ID, rather than every instance."""
+        return self._fetch_matching(instance_ids=[instance_id])
+
+    def _fetch_matching(self, **lookup) -> InstancesRepository:
+        # The SSM lookup needs the IDs of the matching instances so it has to wait for EC2
+        ec2_metadata = Ec2MetadataClient(self._clients['EC2'], **lookup)
+        instance_ids = [instance.instance_id for instance in ec2_metadata.running()]
+        ssm_metadata = SsmMetadataClient(self._clients['SSM'], instance_ids)
+
+        return InstancesRepository(list(self._merge_instance_metadata(ec2_metadata.all(), ssm_metadata)))
+
+    def _merge_instance_metadata(self, ec2_metadata: List['Ec2InstanceMetadata'],
+                                 ssm_metadata: 'SsmMetadataClient') -> Generator[Instance, None, None]:
+        return merge_instance_metadata(ec2_metadata, ssm_metadata, self._region, self._account_id)
+
+
+def merge_instance_metadata(ec2_metadata: List['Ec2InstanceMetadata'], ssm_metadata: 'SsmMetadataClient', region: str,
+                            account_id: Optional[str] = None) -> Generator[Instance, None, None]:
+    """Combine the EC2 and SSM metadata for the running instances into the instances sessh uses."""
+    for instance_metadata in ec2_metadata:
+        if not instance_metadata.is_running():
+            continue
+
+        if ssm_metadata.is_managed(instance_metadata.instance_id):
+            connection_type = ConnectionType.SESSION_MANAGER
+        else:
+            connection_type = ConnectionType.SSH
+
+        yield Instance(instance_metadata.instance_id, instance_metadata.get_name(), instance_metadata.public_ip,
+                       instance_metadata.private_ip, instance_metadata.launch_time, connection_type,
+                       instance_metadata.ssh_key_name, instance_metadata.state, region, account_id,
+                       ssm_metadata.get_ping_status(instance_metadata.instance_id),
+                       ssm_metadata.get_ping_age_seconds(instance_metadata.instance_id))
+
+
+class Ec2InstanceMetadata:
+    # Only the fields sessh uses are kept, rather than everything describe_instances returns
+    __slots__ = ('instance_id', 'name', 'public_ip', 'private_ip', 'state', 'launch_time', 'ssh_key_name')
+
+    def __init__(self, instance_id: str, public_ip: Optional[str], private_ip: Optional[str], state: str,
+                 launch_time: datetime, ssh_key_name, name: Optional[str]):
+        self.instance_id = instance_id
+        self.private_ip = private_ip
+        self.public_ip = public_ip
+        self.state = state
+        self.launch_time = launch_time
+        self.ssh_key_name = ssh_key_name
+        self.name = name
+
+    def is_running(self) -> bool:
+        return self.state == 'running'
+
+    def get_name(self) -> str:
+        """Get the instance name based on the tag with the key "Name"."""
+        return self.name if self.name is not None else "-No name set-"
+
+
+class Ec2MetadataClient:
+    def __init__(self, client=None, filters: Optional[List[Dict]] = None, instance_ids: Optional[List[str]] = None):
+        """
+        :param filters: only fetch the instances matching these `describe_instances` filters
+        :param instance_ids: only fetch these instances
+        """
+        self._client = client or create_client('ec2')
+        self._lookup = {}
+        if filters is not None:
+            self._lookup['Filters'] = filters
+        if instance_ids is not None:
+            self._lookup['InstanceIds'] = instance_ids
+
+        self._instances = list(self._fetch_metadata())
+
+    def all(self) -> List[Ec2InstanceMetadata]:
+        return self._instances
+
+    def running(self) -> List[Ec2InstanceMetadata]:
+        return [i for i in self._instances if i.is_running()]
+
+    def _fetch_metadata(self) -> Generator[Ec2InstanceMetadata, None, None]:
+        for page in fetch_ec2_metadata_pages(self._client, **self._lookup):
+            yield from page
+
+
+def fetch_ec2_metadata_pages(client, **lookup) -> Generator[List[Ec2InstanceMetadata], None, None]:
+    """
+    Fetch the EC2 metadata a page at a time, so the instances can be used before every page has been fetched.
+
+    :param lookup: the `describe_instances` filters or instance IDs to fetch, instead of every instance
+    """
+    paginator = client.get_paginator('describe_instances')
+    # The page size can't be set when looking up instance IDs
+    if 'InstanceIds' not in lookup and _transport.describe_instances_page_size:
+        lookup = {**lookup, 'PaginationConfig': {'PageSize': _transport.describe_instances_page_size}}
+
+    page_iterator = paginator.paginate(**lookup)
+
+    try:
+        for page in page_iterator:
+            yield [
+                Ec2InstanceMetadata(
+                    instance['InstanceId'],
+                    instance.get('PublicIpAddress'),
+                    instance.get('PrivateIpAddress'),
+                    instance['State']['Name'],
+                    instance['LaunchTime'],
+                    instance.get('KeyName'),
+                    _get_name_tag(instance.get('Tags', []))
+                )
+                for reservations in page['Reservations']
+                for instance in reservations['Instances']
+            ]
+    except ClientError as e:
+        # Looking up an instance ID that doesn't exist is an error rather than an empty result
+        if e.response['Error']['Code'] not in ('InvalidInstanceID.NotFound', 'InvalidInstanceID.Malformed'):
+            raise
+
+
+def _get_name_tag(tags: List[Dict[str, str]]) -> Optional[str]:
+    # Only the name is kept, so the rest of the tags are freed along with the page they came in
+    for tag in tags:
+        if tag['Key'] == 'Name':
+            return tag['Value']
+
+    return None
+
+
+def get_running_instance_metadata(instance_id: str, region: str,
+                                  session: Optional[boto3.Session] = None) -> Optional[Ec2InstanceMetadata]:
+    """
+    Fetch the metadata for a single instance, without fetching the metadata for every instance.
+
+    :return: the instance's metadata, or None if it isn't running
+    """
+    running = Ec2MetadataClient(create_client('ec2', region, session), instance_ids=[instance_id]).running()
+
+    return running[0] if running else None
+
+
+class SsmMetadataClient:
+    instance_ids_per_request = 50
+    """The most instance IDs `describe_instance_information` can be filtered by in a single request"""
+
+    def __init__(self, client=None, instance_ids: Optional[List[str]] = None):
+        """
+        :param instance_ids: only fetch these instances
+        """
+        self._client = client or create_client('ssm')
+        self._instance_ids = instance_ids
+        self._fetched_at = time.time()
+        self._instances = self._fetch_metadata()
+
+    def all(self) -> Set[str]:
+        return set(self._instances)
+
+    def is_managed(self, instance_id: str) -> bool:
+        """Whether the instance is managed by Systems Manager, so Session Manager can be used to connect to it."""
+        return instance_id in self._instances
+
+    def get_ping_status(self, instance_id: str) -> Optional[str]:
+        """Whether the instance's SSM agent is `Online`, `ConnectionLost` or `Inactive`, or None if it isn't managed."""
+        return self._instances[instance_id][0] if instance_id in self._instances else None
+
+    def get_ping_age_seconds(self, instance_id: str) -> Optional[float]:
+        """How long before the metadata was fetched the instance's SSM agent last pinged SSM, if it is managed."""
+        last_ping = self._instances[instance_id][1] if instance_id in self._instances else None
+
+        return None if last_ping is None else max(self._fetched_at - last_ping, 0.0)
+
+    def _fetch_metadata(self) -> Dict[str, Tuple[str, Optional[float]]]:
+        paginator = self._client.get_paginator('describe_instance_information')
+        pagination = {'PageSize': _transport.describe_instance_information_page_size} \
+            if _transport.describe_instance_information_page_size else {}
+
+        if self._instance_ids is None:
+            return self._fetch_ping_statuses(paginator.paginate(PaginationConfig=pagination))
+
+        batches = list(batch(self._instance_ids, self.instance_ids_per_request))
+        if len(batches) == 1:
+            return self._fetch_ping_statuses(
+                paginator.paginate(Filters=[{'Key': 'InstanceIds', 'Values': batches[0]}], PaginationConfig=pagination))
+
+        # Each batch is a separate request, so they are fetched at the same time
+        results = run_concurrently(f"SSM metadata for {len(self._instance_ids)} instances", {
+            index: partial(self._fetch_ping_statuses,
+                           paginator.paginate(Filters=[{'Key': 'InstanceIds', 'Values': instance_ids}],
+                                              PaginationConfig=pagination))
+            for index, instance_ids in enumerate(batches)
+        }, _transport.max_concurrent_ssm_requests)
+
+        return {instance_id: ping for result in results.values() for instance_id, ping in result.items()}
+
+    @staticmethod
+    def _fetch_ping_statuses(page_iterator) -> Dict[str, Tuple[str, Optional[float]]]:
+        # Only whether an instance is managed and its agent is online are used, so only those are kept rather than
+        # every page
+        return {instance_info['InstanceId']: (instance_info.get('PingStatus', 'Online'),
+                                              _get_timestamp(instance_info.get('LastPingDateTime')))
+                for page in page_iterator
+                for instance_info in page['InstanceInformationList']}
+
+
+def _get_timestamp(date_time: Optional[datetime]) -> Optional[float]:
+    return date_time.timestamp() if date_time is not None else None
+
+
+class SsmCommandClient:
+    """Runs shell commands on instances using Systems Manager Run Command."""
+
+    # The most instances a command can be sent to at once
+    instance_ids_per_request = 50
+    finished_statuses = ('Success', 'Cancelled', 'TimedOut', 'Failed')
+    min_delivery_timeout_seconds = 30
+
+    def __init__(self, client=None):
+        self._client = client if client else create_client('ssm')
+
+    def send_command(self, instance_ids: List[str], command: str, max_concurrency: int, timeout_seconds: int) -> str:
+        """
+        Send the command to up to instance_ids_per_request instances.
+
+        :param max_concurrency: the most instances to run the command on at the same time
+        :param timeout_seconds: stop the command if it hasn't started within this long, or has been running for this
+        long
+        :return: the command ID
+        """
+        response = self._client.send_command(InstanceIds=instance_ids, DocumentName='AWS-RunShellScript',
+                                             Parameters={'commands': [command],
+                                                         'executionTimeout': [str(timeout_seconds)]},
+                                             MaxConcurrency=str(max_concurrency),
+                                             # Run Command doesn't allow less than this to deliver the command
+                                             TimeoutSeconds=max(timeout_seconds, self.min_delivery_timeout_seconds))
+
+        return response['Command']['CommandId']
+
+    def get_finished_invocations(self, command_id: str) -> List[Dict]:
+        """Get the results for each instance the command has finished running on, including its output."""
+        paginator = self._client.get_paginator('list_command_invocations')
+
+        return [invocation
+                for page in paginator.paginate(CommandId=command_id, Details=True)
+                for invocation in page['CommandInvocations']
+                if invocation['Status'] in self.finished_statuses]
+
+
+def batch(items: List[str], batch_size: int) -> Generator[List[str], None, None]:
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+class AccountMetadataClient(object):
+    def __init__(self, client=None):
+        self._client = client or create_client('sts')
+        self._metadata = self._fetch_metadata()
+
+    def get_account_id(self) -> str:
+        return self._metadata['Account']
+
+    def _fetch_metadata(self) -> Dict[str, str]:
+        return self._client.get_caller_identity()
+
+
+STATIC_CREDENTIAL_METHODS = ('explicit', 'env', 'shared-credentials-file', 'config-file')
+"""Where botocore found credentials that are access keys, rather than credentials it fetches and refreshes itself"""
+
+TEMPORARY_CREDENTIALS_LIFETIME_SECONDS = 3600
+"""How long to assume temporary credentials last for when they don't say when they expire"""
+
+
+def get_account_id(identity_cache: cache.IdentityCache, session: Optional[boto3.Session] = None) -> str:
+    """
+    Get the AWS account the credentials belong to. The identity cache is checked first so STS only has to be asked
+    once for each set of credentials.
+
+    :param session: the session for the account, instead of the current credentials
+    """
+    with timings.span('resolve credentials'):
+        credentials = (session or boto3.DEFAULT_SESSION).get_credentials()
+    credentials_key = _get_credentials_key(session or boto3.DEFAULT_SESSION, credentials)
+    account_id = identity_cache.get_account_id(credentials_key) if credentials_key else None
+
+    if account_id is None:
+        account_id = AccountMetadataClient(create_client('sts', session=session)).get_account_id()
+
+        if credentials_key:
+            identity_cache.save(credentials_key, account_id, _get_credentials_expiry(credentials))
+
+    return account_id
+
+
+def _get_credentials_key(session: boto3.Session, credentials) -> Optional[str]:
+    if credentials is None:
+        return None
+
+    if credentials.method in STATIC_CREDENTIAL_METHODS:
+        # Only a fingerprint is stored so the access key itself isn't written to disk
+        return cache.get_access_key_fingerprint(credentials.access_key)
+
+    # Refreshed credentials have a new access key each time, but always belong to the account the profile is for
+    return f"profile:{session.profile_name}:{credentials.method}"
+
+
+def _get_credentials_expiry(credentials) -> Optional[float]:
+    if credentials.method in STATIC_CREDENTIAL_METHODS and not credentials.token:
+        return None
+
+    expiry_time = getattr(credentials, '_expiry_time', None)
+
+    return expiry_time.timestamp() if expiry_time else time.time() + TEMPORARY_CREDENTIALS_LIFETIME_SECONDS
+
+
+def run_concurrently(description: str, tasks: Dict[Any, Callable[[], Any]],
+                      max_workers: Optional[int] = None) -> Dict[Any, Any]:
+    """
+    Run each task in its own thread and wait for all of them to finish.
+
+    :param max_workers: the most tasks to run at the same time, or all of them if not set
+    :return: the result of each task, with the same key as the task
+    """
+    if not tasks:
+        return {}
+
+    logger = logging.getLogger(__name__)
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=min(len(tasks), max_workers or len(tasks))) as executor:
+        futures = {key: executor.submit(_run_timed, task) for key, task in tasks.items()}
+        results = {key: future.result() for key, future in futures.items()}
+
+    elapsed = time.perf_counter() - started
+    sequential_elapsed = sum(duration for _, duration in results.values())
+    logger.debug(
+        f"Fetched {description} in {elapsed:.2f}s "
+        f"({', '.join(f'{key} {duration:.2f}s' for key, (_, duration) in results.items())}), "
+        f"saving {sequential_elapsed - elapsed:.2f}s over fetching them one after another"
+    )
+
+    return {key: result for key, (result, _) in results.items()}
+
+
+class Transport:
+    """How clients talk to AWS: their retries, timeouts and connection pool, and how many results are in each page."""
+
+    def __init__(self, client_config: Optional[Config] = None, describe_instances_page_size: Optional[int] = None,
+                 describe_instance_information_page_size: Optional[int] = None, ssm_lookup: str = 'all',
+                 max_concurrent_ssm_requests: int = 4):
+        """
+        :param client_config: the botocore configuration for every client, or botocore's defaults if not set
+        :param describe_instances_page_size: the most instances in each page, or the service's default if not set
+        :param ssm_lookup: 'all' to fetch every managed node from SSM while EC2 is fetched, or 'running_instances' to
+            ask SSM only about the running instances EC2 returns
+        :param max_concurrent_ssm_requests: the most batches of instance IDs to ask SSM about at the same time
+        """
+        self.client_config = client_config
+        self.describe_instances_page_size = describe_instances_page_size
+        self.describe_instance_information_page_size = describe_instance_information_page_size
+        self.ssm_lookup = ssm_lookup
+        self.max_concurrent_ssm_requests = max_concurrent_ssm_requests
+
+    @classmethod
+    def from_configuration(cls, transport_configuration: dict) -> 'Transport':
+        return cls(Config(retries={'mode': transport_configuration['retry_mode'],
+                                   'total_max_attempts': transport_configuration['max_attempts']},
+                          connect_timeout=transport_configuration['connect_timeout_seconds'],
+                          read_timeout=transport_configuration['read_timeout_seconds'],
+                          max_pool_connections=transport_configuration['max_pool_connections']),
+                   transport_configuration['describe_instances_page_size'],
+                   transport_configuration['describe_instance_information_page_size'],
+                   transport_configuration['ssm_lookup'],
+                   transport_configuration['max_concurrent_ssm_requests'])
+
+
+_transport = Transport()
+_clients: Dict[Tuple[Optional[boto3.Session], str, Optional[str]], Any] = {}
+"""The clients already created, by session, service and region, so they share their connections to AWS"""
+_clients_lock = threading.Lock()
+
+
+def configure_transport(transport: Transport):
+    """Use the transport for every client created afterwards."""
+    global _transport
+
+    with _clients_lock:
+        _transport = transport
+        _clients.clear()
+
+
+def discard_clients(session: boto3.Session):
+    """Forget the clients created from a session that is no longer used, so they can be freed."""
+    with _clients_lock:
+        for key in [key for key in _clients if key[0] is session]:
+            del _clients[key]
+
+
+def create_client(service: str, region: Optional[str] = None, session: Optional[boto3.Session] = None):
+    """
+    Get a client from the session for an account, or from the default session for the current credentials. Each
+    client is only created once, and can be used from any thread.
+    """
+    key = (session, service, region)
+
+    # Creating boto3 clients is not thread safe, so only one is created at a time
+    with _clients_lock:
+        if key not in _clients:
+            with timings.span('create client', service=service, region=region):
+                if session is None:
+                    _clients[key] = boto3.client(service, region_name=region, config=_transport.client_config)
+                else:
+                    _clients[key] = session.client(service, region_name=region, config=_transport.client_config)
+
+        return _clients[key]
+
+
+def start_session(instance_id: str, region: str, session: Optional[boto3.Session] = None) -> Tuple[dict, str]:
+    """
+    Start a Session Manager session with the instance, for the Session Manager plugin to connect to.
+
+    :return: the response from `start_session`, and the SSM endpoint the session was started with
+    """
+    client = create_client('ssm', region, session)
+
+    return client.start_session(Target=instance_id), client.meta.endpoint_url
+
+
+def get_credentials_environment(session: Optional[boto3.Session]) -> Optional[Dict[str, str]]:
+    """Get the environment variables that give another process the same credentials as the session."""
+    if session is None:
+        return None
+
+    credentials = session.get_credentials().get_frozen_credentials()
+    environment_variables = {
+        'AWS_ACCESS_KEY_ID': credentials.access_key,
+        'AWS_SECRET_ACCESS_KEY': credentials.secret_key,
+    }
+    if credentials.token:
+        environment_variables['AWS_SESSION_TOKEN'] = credentials.token
+
+    return environment_variables
+
+
+def _run_timed(function: Callable[[], Any]) -> Tuple[Any, float]:
+    """Call the function and return its result along with how many seconds it took."""
+    started = time.perf_counter()
+    result = function()
+
+    return result, time.perf_counter() - started
@@ -0,0 +1,76 @@
+"""Clients that return synthetic fleets of instances like boto3's do, so sessh can be measured without AWS."""
+import datetime
+
+
+class FakeEc2Client:
+    """Returns pages of instances like describe_instances does, creating each page only when it is asked for."""
+
+    def __init__(self, number_instances: int, page_size: int, tags_per_instance: int):
+        self._number_instances = number_instances
+        self._page_size = page_size
+        self._tags_per_instance = tags_per_instance
+
+    def get_paginator(self, operation_name: str):
+        return self
+
+    def paginate(self, **kwargs):
+        for page_start in range(0, self._number_instances, self._page_size):
+            page_end = min(page_start + self._page_size, self._number_instances)
+            yield {'Reservations': [{'Instances': [self._create_instance(index)]}
+                                    for index in range(page_start, page_end)]}
+
+    def _create_instance(self, index: int) -> dict:
+        tags = [{'Key': f'tag-{tag}', 'Value': f'value-{index}-{tag}'} for tag in range(self._tags_per_instance)]
+
+        return {
+            'InstanceId': f'i-{index:017x}',
+            'PrivateIpAddress': f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}',
+            'PublicIpAddress': f'54.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}',
+            'PrivateDnsName': f'ip-10-{index // 65536 % 256}-{index // 256 % 256}-{index % 256}.ec2.internal',
+            'State': {'Code': 16, 'Name': 'running'},
+            'LaunchTime': datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+            'KeyName': 'key',
+            'InstanceType': 't3.micro',
+            'SecurityGroups': [{'GroupName': 'default', 'GroupId': 'sg-0123456789abcdef0'}],
+            'Tags': tags + [{'Key': 'Name', 'Value': f'application-{index:06d}'}],
+        }
+
+
+class FakeSsmClient:
+    """Returns pages of managed instances like describe_instance_information does, for every other instance."""
+
+    def __init__(self, number_instances: int, page_size: int):
+        self._instance_ids = [f'i-{index:017x}' for index in range(0, number_instances, 2)]
+        self._page_size = page_size
+
+    def get_paginator(self, operation_name: str):
+        return self
+
+    def paginate(self, Filters=None, **kwargs):
+        instance_ids = self._instance_ids
+
+        for instance_filter in Filters or []:
+            if instance_filter['Key'] == 'InstanceIds':
+                instance_ids = sorted(set(instance_ids) & set(instance_filter['Values']))
+
+        for page_start in range(0, len(instance_ids), self._page_size):
+            yield {'InstanceInformationList': [{
+                'InstanceId': instance_id,
+                'PingStatus': 'Online',
+                'LastPingDateTime': datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+                'AgentVersion': '3.0.0.0',
+                'PlatformType': 'Linux',
+                'PlatformName': 'Amazon Linux',
+                'ResourceType': 'EC2Instance',
+                'IPAddress': '10.0.0.1',
+                'ComputerName': 'ip-10-0-0-1.ec2.internal',
+            } for instance_id in instance_ids[page_start:page_start + self._page_size]]}
+
+
+class FakeStsClient:
+    def __init__(self, account_id: str = '012345678901'):
+        self._account_id = account_id
+
+    def get_caller_identity(self) -> dict:
+        return {'UserId': 'AIDAEXAMPLE', 'Account': self._account_id,
+                'Arn': f'arn:aws:iam::{self._account_id}:user/sessh'}
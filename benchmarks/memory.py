@@ -0,0 +1,45 @@
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(__file__ + '/../..'))
+
+import aws  # noqa: E402
+from fakes import FakeEc2Client, FakeSsmClient  # noqa: E402
+from instances import InstancesRepository  # noqa: E402
+
+
+def measure(number_instances: int, page_size: int, tags_per_instance: int) -> (int, int):
+    """Get the bytes kept for the instances once they have been fetched, and the most used while fetching them."""
+    gc.collect()
+    tracemalloc.start()
+
+    ec2_metadata = aws.Ec2MetadataClient(FakeEc2Client(number_instances, page_size, tags_per_instance))
+    ssm_metadata = aws.SsmMetadataClient(FakeSsmClient(number_instances, page_size))
+    instances = InstancesRepository(list(aws.merge_instance_metadata(ec2_metadata.all(), ssm_metadata, 'eu-west-1')))
+    del ec2_metadata, ssm_metadata
+    gc.collect()
+
+    retained_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(instances.all()) == number_instances
+
+    return retained_bytes, peak_bytes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure how much memory sessh uses for each instance it fetches")
+    parser.add_argument('--instances', help="comma separated numbers of instances to fetch", default='1000,10000,50000')
+    parser.add_argument('--page-size', help="how many instances are in each page from AWS", type=int, default=1000)
+    parser.add_argument('--tags', help="how many tags each instance has, as well as its name", type=int, default=10)
+
+    args = parser.parse_args()
+
+    for number_instances in [int(number) for number in args.instances.split(',')]:
+        retained_bytes, peak_bytes = measure(number_instances, args.page_size, args.tags)
+
+        print(f"{number_instances} instances: {retained_bytes / number_instances:.0f} bytes per instance kept, "
+              f"{peak_bytes / 1024 / 1024:.1f}MB at most while fetching")
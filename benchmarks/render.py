@@ -0,0 +1,56 @@
+import argparse
+import datetime
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(__file__ + '/../..'))
+
+import display  # noqa: E402
+from instances import ConnectionType, Instance  # noqa: E402
+
+TABLE_HEADINGS = {
+    'Name': True,
+    'Instance ID': True,
+    'Launch time': True,
+    'Private IP': True,
+    'Public IP': True,
+    'Connection type': True,
+    'Region': True,
+    'Account': True,
+}
+
+
+def create_instances(number_instances: int) -> list:
+    return [Instance(f'i-{index:017x}', f'application-{index:06d}', None if index % 3 else f'54.0.0.{index % 256}',
+                     f'10.0.{index // 256 % 256}.{index % 256}',
+                     datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+                     ConnectionType.SESSION_MANAGER if index % 2 else ConnectionType.SSH, 'key', 'running',
+                     'eu-west-1', '012345678901')
+            for index in range(number_instances)]
+
+
+def time_renderer(renderer: str, instances: list) -> float:
+    """Get the number of seconds it takes to draw the table of instances."""
+    displayer = display.InstancesDisplayer(TABLE_HEADINGS, {'012345678901': 'aws-account-alias'}, renderer,
+                                           io.StringIO())
+    started = time.perf_counter()
+    displayer.display(instances)
+
+    return time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare how long each table renderer takes to draw the instances")
+    parser.add_argument('--rows', help="comma separated numbers of instances to draw", default='1000,10000,50000')
+    parser.add_argument('--renderers', help="comma separated renderers to compare", default='fast,texttable')
+
+    args = parser.parse_args()
+
+    for number_instances in [int(number) for number in args.rows.split(',')]:
+        instances = create_instances(number_instances)
+        durations = {renderer: time_renderer(renderer, instances) for renderer in args.renderers.split(',')}
+
+        print(f"{number_instances} rows: " + ', '.join(f"{renderer} {duration * 1000:.0f}ms"
+                                                       for renderer, duration in durations.items()))
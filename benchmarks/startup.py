@@ -0,0 +1,93 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that are slow to import and should only be imported by the commands that need them
+HEAVY_MODULES = ['boto3', 'botocore', 'texttable']
+
+# Runs sessh, then says whether the user's configuration was loaded. It is loaded from its cache or by running the
+# configuration file, neither of which is an import, so -X importtime can't show it.
+CONFIGURATION_PROBE = '''
+import atexit
+import os
+import runpy
+import sys
+
+main_path = sys.argv[1]
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(main_path))
+
+import configuration
+
+loaded = []
+load = configuration.UserConfiguration._load
+configuration.UserConfiguration._load = lambda self: loaded.append(True) or load(self)
+atexit.register(lambda: print('configuration loaded' if loaded else 'configuration not loaded', file=sys.stderr))
+
+runpy.run_path(main_path, run_name='__main__')
+'''
+
+
+def time_command(interpreter_path: str, main_path: str, arguments: list, runs: int) -> float:
+    """Get the median number of seconds it takes to run sessh with the arguments."""
+    durations = []
+
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([interpreter_path, main_path] + arguments, check=True, stdout=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - started)
+
+    return statistics.median(durations)
+
+
+def imported_heavy_modules(interpreter_path: str, main_path: str, arguments: list) -> list:
+    """Get the slow to import modules that were imported when running sessh with the arguments."""
+    import_times = subprocess.run([interpreter_path, '-X', 'importtime', main_path] + arguments, check=True,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    imported_modules = {line.rsplit('|', 1)[-1].strip() for line in import_times.splitlines() if '|' in line}
+
+    return [module for module in HEAVY_MODULES if module in imported_modules]
+
+
+def loaded_configuration(interpreter_path: str, main_path: str, arguments: list) -> bool:
+    """Check whether running sessh with the arguments loaded the user's configuration."""
+    output = subprocess.run([interpreter_path, '-c', CONFIGURATION_PROBE, main_path] + arguments, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+
+    return 'configuration loaded' in output.splitlines()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check sessh starts quickly for commands that don't talk to AWS")
+    parser.add_argument('--budget', help="the most milliseconds each command may take", type=float, default=250)
+    parser.add_argument('--runs', help="how many times to run each command", type=int, default=10)
+
+    args = parser.parse_args()
+
+    interpreter_path = sys.executable
+    main_path = os.path.abspath(__file__ + '/../../main.py')
+    within_budget = True
+
+    for command_arguments in (['--version'], ['--help']):
+        duration_ms = time_command(interpreter_path, main_path, command_arguments, args.runs) * 1000
+        heavy_modules = imported_heavy_modules(interpreter_path, main_path, command_arguments)
+        command = ' '.join(command_arguments)
+
+        print(f"{command}: {duration_ms:.0f}ms (budget {args.budget:.0f}ms)")
+
+        if duration_ms > args.budget:
+            print(f"{command} is over budget")
+            within_budget = False
+
+        if heavy_modules:
+            print(f"{command} imports {', '.join(heavy_modules)}")
+            within_budget = False
+
+        if loaded_configuration(interpreter_path, main_path, command_arguments):
+            print(f"{command} loads the configuration")
+            within_budget = False
+
+    sys.exit(0 if within_budget else 1)
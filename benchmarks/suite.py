@@ -0,0 +1,141 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.abspath(__file__ + '/../..'))
+
+import aws  # noqa: E402
+import configuration  # noqa: E402
+import display  # noqa: E402
+import environment  # noqa: E402
+from __init__ import __version__  # noqa: E402
+from fakes import FakeEc2Client, FakeSsmClient, FakeStsClient  # noqa: E402
+from instances import InstancesRepository  # noqa: E402
+
+TABLE_HEADINGS = {
+    'Name': True,
+    'Instance ID': True,
+    'Launch time': True,
+    'Private IP': True,
+    'Public IP': True,
+    'Connection type': True,
+    'Region': True,
+    'Account': True,
+}
+
+NUMBER_LOOKUPS = 1000
+NUMBER_SIMILAR_LOOKUPS = 10
+
+
+class Timer:
+    """Collects how long each step takes over a number of runs."""
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = {}
+
+    def time(self, step: str, function: Callable):
+        started = time.perf_counter()
+        result = function()
+        self.durations.setdefault(step, []).append(time.perf_counter() - started)
+
+        return result
+
+    def get_median_milliseconds(self) -> Dict[str, float]:
+        return {step: round(statistics.median(durations) * 1000, 3) for step, durations in self.durations.items()}
+
+
+def run(timer: Timer, number_instances: int, page_size: int, tags_per_instance: int, configuration_home: str):
+    """Time each step sessh takes to list the instances and look one up, using a synthetic fleet."""
+    account_id = timer.time('fetch_account', lambda: aws.AccountMetadataClient(FakeStsClient()).get_account_id())
+    ec2_metadata = timer.time('fetch_ec2', lambda: aws.Ec2MetadataClient(
+        FakeEc2Client(number_instances, page_size, tags_per_instance)).all())
+    ssm_metadata = timer.time('fetch_ssm', lambda: aws.SsmMetadataClient(FakeSsmClient(number_instances, page_size)))
+    running_instance_ids = [instance.instance_id for instance in ec2_metadata if instance.is_running()]
+    timer.time('fetch_ssm_running', lambda: aws.SsmMetadataClient(FakeSsmClient(number_instances, page_size),
+                                                                  running_instance_ids))
+    merged_instances = timer.time('merge', lambda: list(aws.merge_instance_metadata(ec2_metadata, ssm_metadata,
+                                                                                    'eu-west-1', account_id)))
+
+    # Instances from more than one account and region arrive in no particular order
+    random.Random(number_instances).shuffle(merged_instances)
+    instances = timer.time('repository', lambda: InstancesRepository(merged_instances, account_id))
+
+    names = [instance.name for instance in random.Random(page_size).choices(instances.all(), k=NUMBER_LOOKUPS)]
+    timer.time('lookup_index', lambda: instances.find_running(names[0]))
+    timer.time('lookup_name', lambda: [instances.find_running(name) for name in names])
+    timer.time('lookup_id', lambda: [instances.find_running(instance.instance_id)
+                                     for instance in instances.all()[:NUMBER_LOOKUPS]])
+    timer.time('lookup_prefix', lambda: [instances.find_running_by_instance_name_prefix(name[:-2]) for name in names])
+    timer.time('lookup_similar', lambda: [instances.find_running_similar_to_instance_name(name[1:])
+                                          for name in names[:NUMBER_SIMILAR_LOOKUPS]])
+
+    displayer = display.InstancesDisplayer(TABLE_HEADINGS, {account_id: 'aws-account-alias'}, 'fast', io.StringIO())
+    timer.time('render_table', lambda: displayer.display(instances.running()))
+
+    timer.time('load_configuration', lambda: load_configuration(configuration_home))
+
+
+def load_configuration(configuration_home: str):
+    """Load the configuration again, as if sessh had just started."""
+    os.environ['XDG_CONFIG_HOME'] = configuration_home
+    configuration.UserConfiguration(environment.Checker()).get_table_configuration()
+
+
+def compare(results: dict, baseline: dict):
+    """Print how much slower or faster each step is than in the baseline results."""
+    for step, milliseconds in results['milliseconds'].items():
+        baseline_milliseconds = baseline['milliseconds'].get(step)
+
+        if not baseline_milliseconds:
+            print(f"{step}: {milliseconds:.1f}ms (new)", file=sys.stderr)
+            continue
+
+        change = (milliseconds - baseline_milliseconds) / baseline_milliseconds * 100
+        print(f"{step}: {milliseconds:.1f}ms, {change:+.0f}% compared to {baseline_milliseconds:.1f}ms",
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the steps sessh takes to list and connect to instances, without "
+                                                 "AWS, and write the results as JSON")
+    parser.add_argument('--instances', help="how many instances are in the fleet", type=int, default=10000)
+    parser.add_argument('--page-size', help="how many instances are in each page from AWS", type=int, default=1000)
+    parser.add_argument('--tags', help="how many tags each instance has, as well as its name", type=int, default=10)
+    parser.add_argument('--runs', help="how many times to run each step", type=int, default=5)
+    parser.add_argument('--output', help="the file to write the results to, instead of stdout")
+    parser.add_argument('--baseline', help="results from an earlier run to compare these results with")
+
+    args = parser.parse_args()
+
+    timer = Timer()
+
+    with tempfile.TemporaryDirectory() as configuration_home:
+        for _ in range(args.runs):
+            run(timer, args.instances, args.page_size, args.tags, configuration_home)
+
+    results = {
+        'sessh_version': __version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'fleet': {'instances': args.instances, 'page_size': args.page_size, 'tags': args.tags},
+        'runs': args.runs,
+        'milliseconds': timer.get_median_milliseconds(),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            compare(results, json.load(baseline_file))
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Optional, List, Dict
+
+
+def read_json_file(file_path: str) -> Optional[dict]:
+    """Read a cache file, treating a missing or corrupt file the same as an empty cache."""
+    try:
+        with open(file_path, 'r') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json_file(file_path: str, data: dict):
+    """
+    Write a cache file atomically so a concurrently running sessh never reads half of it.
+    """
+    directory_path = os.path.dirname(file_path)
+    os.makedirs(directory_path, exist_ok=True, mode=0o700)
+
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory_path, suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w') as cache_file:
+            json.dump(data, cache_file)
+
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+class CachedInventory:
+    def __init__(self, instances: List[dict], fetched_at: float, ttl_seconds: int, max_stale_seconds: int):
+        self.instances = instances
+        self.fetched_at = fetched_at
+        self._ttl_seconds = ttl_seconds
+        self._max_stale_seconds = max_stale_seconds
+
+    def age_seconds(self) -> float:
+        return time.time() - self.fetched_at
+
+    def is_fresh(self) -> bool:
+        return self.age_seconds() < self._ttl_seconds
+
+    def is_usable(self) -> bool:
+        """Stale inventories can still be used while they are refreshed, unless they are too old to be trusted."""
+        return self.age_seconds() < self._max_stale_seconds
+
+
+class InventoryCache:
+    """Instances for an AWS account and region, stored on disk so they don't have to be fetched from AWS every time."""
+    format_version = 4
+
+    def __init__(self, directory: str, account_id: str, region: str, ttl_seconds: int, max_stale_seconds: int):
+        self._logger = logging.getLogger(__name__)
+        self._file_path = os.path.join(directory, f'inventory-{account_id}-{region}.json')
+        self._account_id = account_id
+        self.region = region
+        self._ttl_seconds = ttl_seconds
+        self._max_stale_seconds = max_stale_seconds
+
+    def load(self) -> Optional[CachedInventory]:
+        data = read_json_file(self._file_path)
+
+        if data is None or data.get('version') != self.format_version:
+            self._logger.debug(f"No usable inventory cache at {self._file_path}")
+            return None
+
+        inventory = CachedInventory(data['instances'], data['fetched_at'], self._ttl_seconds, self._max_stale_seconds)
+        self._logger.debug(f"Loaded {len(inventory.instances)} instances from {self._file_path}, cached "
+                           f"{inventory.age_seconds():.0f}s ago")
+
+        return inventory
+
+    def save(self, instances: List[dict]):
+        write_json_file(self._file_path, {
+            'version': self.format_version,
+            'account_id': self._account_id,
+            'region': self.region,
+            'fetched_at': time.time(),
+            'instances': instances,
+        })
+        self._logger.debug(f"Saved {len(instances)} instances to {self._file_path}")
+
+
+def get_access_key_fingerprint(access_key: str) -> str:
+    """Identify an access key without containing it, so it can be written to disk and sent to `sessh daemon`."""
+    return f"access-key:{hashlib.sha256(access_key.encode()).hexdigest()[:16]}"
+
+
+class IdentityCache:
+    """The AWS account each set of credentials belongs to, so STS doesn't have to be asked on every run."""
+
+    def __init__(self, directory: str):
+        self._logger = logging.getLogger(__name__)
+        self._file_path = os.path.join(directory, 'identity.json')
+
+    def get_account_id(self, credentials_key: str) -> Optional[str]:
+        identity = self._load().get(credentials_key)
+
+        if identity is None or self._has_expired(identity):
+            return None
+
+        self._logger.debug(f"Found account {identity['account_id']} for {credentials_key} in the identity cache")
+
+        return identity['account_id']
+
+    def save(self, credentials_key: str, account_id: str, expires_at: Optional[float]):
+        """
+        :param expires_at: when the credentials expire, as a timestamp, or None if they don't expire
+        """
+        identities = {key: identity for key, identity in self._load().items() if not self._has_expired(identity)}
+        identities[credentials_key] = {'account_id': account_id, 'expires_at': expires_at}
+        write_json_file(self._file_path, identities)
+
+    def _load(self) -> Dict[str, dict]:
+        return read_json_file(self._file_path) or {}
+
+    @staticmethod
+    def _has_expired(identity: dict) -> bool:
+        return identity['expires_at'] is not None and identity['expires_at'] <= time.time()
+
+
+class LatencyCache:
+    """How long it took to connect to each bastion, so they don't all have to be probed every time sessh connects."""
+
+    def __init__(self, directory: str, ttl_seconds: int):
+        self._file_path = os.path.join(directory, 'latencies.json')
+        self._ttl_seconds = ttl_seconds
+
+    def get(self, destinations: List[str]) -> Dict[str, Optional[float]]:
+        """
+        Get the latencies of the destinations that were probed recently enough to still be used.
+
+        :return: how long each destination took to connect to in seconds, or None if it couldn't be connected to
+        """
+        latencies = self._load()
+
+        return {destination: latencies[destination]['seconds'] for destination in destinations
+                if destination in latencies and not self._has_expired(latencies[destination])}
+
+    def save(self, latencies: Dict[str, Optional[float]]):
+        probed_at = time.time()
+        saved_latencies = {destination: latency for destination, latency in self._load().items()
+                           if not self._has_expired(latency)}
+        saved_latencies.update({destination: {'seconds': seconds, 'probed_at': probed_at}
+                                for destination, seconds in latencies.items()})
+        write_json_file(self._file_path, saved_latencies)
+
+    def _load(self) -> Dict[str, dict]:
+        return read_json_file(self._file_path) or {}
+
+    def _has_expired(self, latency: dict) -> bool:
+        return time.time() - latency['probed_at'] >= self._ttl_seconds
+
+
+class ToolCache:
+    """Where each command line tool sessh uses was found, and its version, so they don't have to be looked up again."""
+
+    def __init__(self, directory: str):
+        self._file_path = os.path.join(directory, 'tools.json')
+
+    def get(self, name: str) -> Optional[dict]:
+        return self._load().get(name)
+
+    def save(self, name: str, tool: dict):
+        tools = self._load()
+        tools[name] = tool
+        write_json_file(self._file_path, tools)
+
+    def _load(self) -> Dict[str, dict]:
+        return read_json_file(self._file_path) or {}
+
+
+class ConfigurationCache:
+    """
+    The user's configuration once it has been checked, so the configuration file only has to be run and checked again
+    when it changes.
+    """
+    format_version = 1
+
+    def __init__(self, directory: str):
+        self._logger = logging.getLogger(__name__)
+        self._file_path = os.path.join(directory, 'configuration.json')
+
+    def load(self, source_path: str, source_stat: os.stat_result) -> Optional[dict]:
+        data = read_json_file(self._file_path)
+
+        if data is None or data.get('version') != self.format_version or data.get('source') != \
+                self._describe_source(source_path, source_stat):
+            self._logger.debug(f"No usable configuration cache for {source_path} at {self._file_path}")
+            return None
+
+        return data['configuration']
+
+    def save(self, source_path: str, source_stat: os.stat_result, configuration: dict):
+        write_json_file(self._file_path, {
+            'version': self.format_version,
+            'source': self._describe_source(source_path, source_stat),
+            'configuration': configuration,
+        })
+        self._logger.debug(f"Saved the configuration from {source_path} to {self._file_path}")
+
+    @staticmethod
+    def _describe_source(source_path: str, source_stat: os.stat_result) -> dict:
+        return {'path': source_path, 'mtime_ns': source_stat.st_mtime_ns, 'size': source_stat.st_size}
@@ -4,11 +4,35 @@ GENERAL = {
         'accounts': {
             '012345678901': {
                 'alias': 'aws-account-alias',
+                # How to access the account when using --accounts or --all-accounts. Either a role to assume using your
+                # current credentials, or a named AWS profile. Without either, the account can only be used when your
+                # current credentials belong to it.
+                'role_arn': 'arn:aws:iam::012345678901:role/sessh',
             },
             '10987654321': {
                 'alias': 'other-aws-account',
+                'profile': 'other-aws-account',
             },
-        }
+        },
+        # How many accounts to fetch instances from at the same time when using --accounts or --all-accounts
+        'max_concurrent_accounts': 4,
+        # How sessh talks to AWS. Bigger pages mean fewer requests when there are lots of instances. Throttled requests
+        # are retried, up to max_attempts requests in total, with 'adaptive' also slowing down requests to AWS while it
+        # is throttling them. The timeouts stop sessh waiting forever for an endpoint that doesn't respond.
+        'transport': {
+            'describe_instances_page_size': 1000,
+            'describe_instance_information_page_size': 50,
+            'retry_mode': 'adaptive',
+            'max_attempts': 10,
+            'connect_timeout_seconds': 5,
+            'read_timeout_seconds': 30,
+            'max_pool_connections': 20,
+            # 'all' fetches every node managed by SSM at the same time as the EC2 instances. 'running_instances' asks
+            # SSM only about the running EC2 instances, up to max_concurrent_ssm_requests batches at a time, which is
+            # faster when SSM also manages lots of on-premises servers or stopped instances.
+            'ssm_lookup': 'all',
+            'max_concurrent_ssm_requests': 4,
+        },
     },
     'list': {
         # Which table headings should be displayed.
@@ -20,8 +44,59 @@ GENERAL = {
             'Private IP': False,
             'Public IP': False,
             'Connection type': True,
-        }
-    }
+            # Always shown when listing instances in more than one region
+            'Region': False,
+            # Always shown when listing instances in more than one account
+            'Account': False,
+        },
+        # 'fast' draws tables quickly however many instances there are. 'texttable' is slower, but wraps long values so
+        # the table fits in the terminal.
+        'table_renderer': 'fast',
+    },
+    'inventory_cache': {
+        # Instances are cached next to this file so `list` and `connect` don't have to fetch them from AWS every time.
+        # Use `--refresh` to ignore the cache.
+        'enabled': True,
+        # Cached instances older than this are still used, but are refreshed in the background.
+        'ttl_seconds': 300,
+        # Cached instances older than this are never used. They are fetched from AWS instead.
+        'max_stale_seconds': 86400,
+    },
+    'ssh_multiplexing': {
+        # SSH connections to bastions and instances are shared, so connecting again doesn't have to wait to connect and
+        # authenticate. Not available on Windows. Use `sessh ssh-master status` and `sessh ssh-master stop` to manage
+        # them.
+        'enabled': True,
+        # How long a shared connection is kept open for after the last session using it ends.
+        'persist_seconds': 600,
+        # Start connecting to the account's bastion while `sessh connect` looks the instance up, so the connection is
+        # ready by the time it is needed. It is abandoned if the instance is connected to using Session Manager.
+        'speculative': True,
+    },
+    'session_manager': {
+        # Session Manager sessions are started by sessh, then handed to the Session Manager plugin. Set this to True to
+        # start them using `aws ssm start-session` instead, which needs the AWS CLI to be installed.
+        'use_aws_cli': False,
+    },
+    'routing': {
+        # Session Manager is only used while the instance's SSM agent is online. Otherwise the bastion and the
+        # instance's public IP address are probed at the same time, and SSH is used with the fastest one that answers.
+        # If a route fails, the next best one is tried. Set this to False to always use Session Manager for managed
+        # instances, and SSH for the others.
+        'enabled': True,
+        # The SSM agent is treated as offline if it hadn't pinged SSM for this long when the instance was fetched.
+        'max_ssm_ping_age_seconds': 900,
+        # How long to wait for a bastion or the instance to answer on the SSH port.
+        'probe_timeout_seconds': 1,
+        # How long to remember how fast each bastion answered, so they don't all have to be probed every time.
+        'bastion_latency_cache_seconds': 300,
+    },
+    'daemon': {
+        # `list` and `connect` use the instances `sessh daemon run` keeps in memory, when it is running.
+        'enabled': True,
+        # How often the daemon fetches the instances it has in memory from AWS again.
+        'refresh_seconds': 60,
+    },
 }
 
 # Connection configuration for bastions
@@ -38,7 +113,9 @@ BASTIONS = [
     },
     {
         'aws_account_alias': 'other-aws-account',
-        'bastion_host': 'bastion.staging.example.com',
+        # An account can have more than one bastion, like one in each availability zone. The one that answers fastest
+        # is used, and the next fastest if it stops answering.
+        'bastion_host': ['bastion-a.staging.example.com', 'bastion-b.staging.example.com'],
         'bastion_user': 'ec2-user',
         # Make sure you `ssh-add` any required SSH keys if you don't specify them here.
         'ssh_keys': None,
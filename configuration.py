@@ -1,10 +1,20 @@
+import importlib.util
+import json
 import logging
 import os
 import shutil
 import sys
-from typing import Optional, List
+from typing import Optional, List, Dict, Any, Tuple, Union
 
+import cache
 import environment
+import timings
+
+TABLE_HEADINGS = ('Name', 'Instance ID', 'Launch time', 'Private IP', 'Public IP', 'Connection type', 'Region',
+                  'Account')
+TABLE_RENDERERS = ('fast', 'texttable')
+RETRY_MODES = ('legacy', 'standard', 'adaptive')
+SSM_LOOKUPS = ('all', 'running_instances')
 
 
 def resource_path(relative_path):
@@ -19,25 +29,87 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
+class Configuration:
+    """The settings from the user's configuration file once they have been checked, indexed for looking them up."""
+
+    def __init__(self, general: dict, bastions: List[dict]):
+        self.general = general
+        self.bastions = bastions
+        self.account_ids_by_alias = {account['alias']: account_id
+                                     for account_id, account in general['aws']['accounts'].items()}
+        self.bastions_by_alias = {bastion['aws_account_alias']: bastion for bastion in bastions}
+
+    def to_dict(self) -> dict:
+        return {'GENERAL': self.general, 'BASTIONS': self.bastions}
+
+    @classmethod
+    def from_dict(cls, configuration: dict) -> 'Configuration':
+        return cls(configuration['GENERAL'], configuration['BASTIONS'])
+
+
 class UserConfiguration:
     def __init__(self, environment: environment.Checker):
         self._logger = logging.getLogger(__name__)
         self._environment = environment
         self._config_file_path = self._generate_path_to_config_file()
-        self.configuration = self._load()
+        self._configuration = None
+
+    @property
+    def configuration(self) -> Configuration:
+        """The user's configuration file, which is only loaded the first time it is needed."""
+        if self._configuration is None:
+            with timings.span('load configuration'):
+                self._configuration = self._load()
+
+        return self._configuration
 
-    def _load(self):
+    def _load(self) -> Configuration:
+        """
+        Load the configuration from the configuration cache, or run and check the configuration file if it has changed
+        since it was cached.
+        """
         if not self._configuration_file_exists():
             self._logger.debug(
                 f"Configuration file not found at {self.get_file_path()} so the default one will be created"
             )
             self._create_initial_configuration_file()
 
-        # Append user configuration path and import it
-        sys.path.append(os.path.abspath(os.path.dirname(self.get_file_path())))
-        import config
+        file_stat = os.stat(self.get_file_path())
+        configuration_cache = cache.ConfigurationCache(self.get_cache_directory())
+        cached_configuration = configuration_cache.load(self.get_file_path(), file_stat)
+
+        if cached_configuration is not None:
+            return Configuration.from_dict(cached_configuration)
+
+        with timings.span('run configuration file'):
+            configuration = self._run_configuration_file()
 
-        return config
+        try:
+            # Only settings that are the same once they have been through JSON can be cached
+            if json.loads(json.dumps(configuration.to_dict())) == configuration.to_dict():
+                configuration_cache.save(self.get_file_path(), file_stat, configuration.to_dict())
+        except (OSError, TypeError, ValueError) as e:
+            self._logger.debug(f"Unable to cache the configuration from {self.get_file_path()}: {e}")
+
+        return configuration
+
+    def _run_configuration_file(self) -> Configuration:
+        try:
+            specification = importlib.util.spec_from_file_location('config', self.get_file_path())
+            config = importlib.util.module_from_spec(specification)
+            specification.loader.exec_module(config)
+        except Exception as e:
+            raise RuntimeError(f"Unable to load the configuration file {self.get_file_path()}: {e}") from e
+
+        general = getattr(config, 'GENERAL', None)
+        bastions = getattr(config, 'BASTIONS', None)
+        problems = validate_configuration(general, bastions)
+
+        if problems:
+            raise RuntimeError(f"The configuration file {self.get_file_path()} has problems:\n" +
+                               '\n'.join(f"- {problem}" for problem in problems))
+
+        return Configuration(general, bastions)
 
     def _configuration_file_exists(self) -> bool:
         return os.path.isfile(self._config_file_path)
@@ -64,34 +136,118 @@ class UserConfiguration:
         self._logger.debug(f"Copying template configuration to {self.get_file_path()}")
         shutil.copyfile(resource_path('config.default.py'), self.get_file_path())
 
+    def get_cache_directory(self) -> str:
+        return os.path.join(os.path.dirname(self.get_file_path()), 'cache')
+
+    def get_inventory_cache_configuration(self) -> dict:
+        # Configuration files created by older versions of sessh don't have this section
+        defaults = {'enabled': True, 'ttl_seconds': 300, 'max_stale_seconds': 86400}
+
+        return {**defaults, **self.configuration.general.get('inventory_cache', {})}
+
+    def get_ssh_control_directory(self) -> str:
+        return os.path.join(os.path.dirname(self.get_file_path()), 'ssh')
+
+    def get_ssh_multiplexing_configuration(self) -> dict:
+        # Configuration files created by older versions of sessh don't have this section
+        defaults = {'enabled': True, 'persist_seconds': 600, 'speculative': True}
+
+        return {**defaults, **self.configuration.general.get('ssh_multiplexing', {})}
+
+    def get_daemon_socket_path(self) -> str:
+        return os.path.join(os.path.dirname(self.get_file_path()), 'daemon', 'daemon.sock')
+
+    def get_daemon_configuration(self) -> dict:
+        # Configuration files created by older versions of sessh don't have this section
+        defaults = {'enabled': True, 'refresh_seconds': 60}
+
+        return {**defaults, **self.configuration.general.get('daemon', {})}
+
+    def get_session_manager_configuration(self) -> dict:
+        # Configuration files created by older versions of sessh don't have this section
+        defaults = {'use_aws_cli': False}
+
+        return {**defaults, **self.configuration.general.get('session_manager', {})}
+
+    def get_routing_configuration(self) -> dict:
+        # Configuration files created by older versions of sessh don't have this section
+        defaults = {'enabled': True, 'max_ssm_ping_age_seconds': 900, 'probe_timeout_seconds': 1,
+                    'bastion_latency_cache_seconds': 300}
+
+        return {**defaults, **self.configuration.general.get('routing', {})}
+
     def get_table_configuration(self) -> dict:
-        return self.configuration.GENERAL['list']['table_headings']
+        return self.configuration.general['list']['table_headings']
+
+    def get_table_renderer(self) -> str:
+        return self.configuration.general['list'].get('table_renderer', 'fast')
 
     def get_bastion_configuration_details_for_account(self, account_alias: str) -> dict:
-        for bastion_configuration in self.configuration.BASTIONS:
-            if bastion_configuration['aws_account_alias'] == account_alias:
-                return bastion_configuration
+        if account_alias in self.configuration.bastions_by_alias:
+            return self.configuration.bastions_by_alias[account_alias]
 
         raise RuntimeError(f"There is no bastion configuration for account alias {account_alias}. Add the "
                            f"configuration in {self.get_file_path()}")
 
-    def get_bastion_connection_details_for_account_id(self, account_id: str) -> str:
+    def get_bastion_connections_for_account_id(self, account_id: str) -> List[str]:
+        """Get each of the account's bastions as user@host, in the order they are configured."""
         account_alias = self.get_account_alias(account_id)
         bastion_configuration = self.get_bastion_configuration_details_for_account(account_alias)
         bastion_user = bastion_configuration['bastion_user']
-        bastion_host = bastion_configuration['bastion_host']
+        bastion_hosts = bastion_configuration['bastion_host']
+
+        # A single bastion can be configured without a list
+        if isinstance(bastion_hosts, str):
+            bastion_hosts = [bastion_hosts]
 
-        return f'{bastion_user}@{bastion_host}'
+        return [f'{bastion_user}@{bastion_host}' for bastion_host in bastion_hosts]
 
     def get_account_alias(self, account_id: str) -> str:
-        if account_id not in self.configuration.GENERAL['aws']['accounts']:
+        return self.get_account_configuration(account_id)['alias']
+
+    def get_account_aliases(self) -> Dict[str, str]:
+        accounts = self.configuration.general['aws']['accounts']
+
+        return {account_id: account['alias'] for account_id, account in accounts.items()}
+
+    def get_account_configuration(self, account_id: str) -> dict:
+        if account_id not in self.configuration.general['aws']['accounts']:
             raise RuntimeError(f"There is no AWS account alias configuration for account {account_id}. Add the "
                                f"configuration to GENERAL['accounts']['{account_id}'] in {self.get_file_path()}")
 
-        return self.configuration.GENERAL['aws']['accounts'][account_id]['alias']
+        return self.configuration.general['aws']['accounts'][account_id]
+
+    def get_account_ids(self) -> List[str]:
+        return list(self.configuration.general['aws']['accounts'])
+
+    def get_account_id_for_alias(self, account_alias: str) -> str:
+        if account_alias in self.configuration.account_ids_by_alias:
+            return self.configuration.account_ids_by_alias[account_alias]
+
+        raise RuntimeError(f"There is no AWS account with the alias {account_alias}. Add the configuration to "
+                           f"GENERAL['aws']['accounts'] in {self.get_file_path()}")
+
+    def get_max_concurrent_accounts(self) -> int:
+        return self.configuration.general['aws'].get('max_concurrent_accounts', 4)
+
+    def get_aws_transport_configuration(self) -> dict:
+        # Configuration files created by older versions of sessh don't have this section
+        defaults = {
+            'describe_instances_page_size': 1000,
+            'describe_instance_information_page_size': 50,
+            'retry_mode': 'adaptive',
+            'max_attempts': 10,
+            'connect_timeout_seconds': 5,
+            'read_timeout_seconds': 30,
+            'max_pool_connections': 20,
+            'ssm_lookup': 'all',
+            'max_concurrent_ssm_requests': 4,
+        }
+
+        return {**defaults, **self.configuration.general['aws'].get('transport', {})}
 
     def get_default_region(self) -> str:
-        return self.configuration.GENERAL['aws']['region']
+        return self.configuration.general['aws']['region']
 
     def get_file_path(self) -> str:
         return self._config_file_path
@@ -102,3 +258,178 @@ class UserConfiguration:
 
         if 'ssh_keys' in bastion_configuration:
             return bastion_configuration['ssh_keys']
+
+
+_MISSING = object()
+
+_TYPE_DESCRIPTIONS = {
+    str: 'text',
+    bool: 'True or False',
+    int: 'a whole number',
+    float: 'a number',
+    dict: 'a dict',
+    list: 'a list',
+    type(None): 'None',
+}
+
+
+def validate_configuration(general: Any, bastions: Any) -> List[str]:
+    """Find the problems with the settings in a configuration file, described by where they are in the file."""
+    problems = []
+
+    if not isinstance(general, dict):
+        return ["GENERAL is missing, or isn't a dict"]
+
+    aws = _check_setting(problems, general, 'GENERAL', 'aws', dict)
+    if aws is not None:
+        _check_setting(problems, aws, "GENERAL['aws']", 'region', str)
+        _check_setting(problems, aws, "GENERAL['aws']", 'max_concurrent_accounts', int, required=False, minimum=1)
+        accounts = _check_setting(problems, aws, "GENERAL['aws']", 'accounts', dict)
+
+        for account_id, account in (accounts or {}).items():
+            path = f"GENERAL['aws']['accounts']['{account_id}']"
+
+            if not isinstance(account, dict):
+                problems.append(f"{path} should be a dict")
+                continue
+
+            _check_setting(problems, account, path, 'alias', str)
+            _check_setting(problems, account, path, 'role_arn', str, required=False)
+            _check_setting(problems, account, path, 'profile', str, required=False)
+
+        aliases = [account.get('alias') for account in (accounts or {}).values() if isinstance(account, dict)]
+        for alias in sorted({alias for alias in aliases if aliases.count(alias) > 1}, key=str):
+            problems.append(f"More than one account in GENERAL['aws']['accounts'] has the alias {alias}")
+
+        transport = _check_setting(problems, aws, "GENERAL['aws']", 'transport', dict, required=False)
+        if transport is not None:
+            path = "GENERAL['aws']['transport']"
+            _check_setting(problems, transport, path, 'describe_instances_page_size', int, required=False, minimum=5,
+                           maximum=1000)
+            _check_setting(problems, transport, path, 'describe_instance_information_page_size', int, required=False,
+                           minimum=5, maximum=50)
+            _check_setting(problems, transport, path, 'retry_mode', str, required=False, choices=RETRY_MODES)
+            _check_setting(problems, transport, path, 'max_attempts', int, required=False, minimum=1)
+            _check_setting(problems, transport, path, 'connect_timeout_seconds', (int, float), required=False,
+                           minimum=0)
+            _check_setting(problems, transport, path, 'read_timeout_seconds', (int, float), required=False, minimum=0)
+            _check_setting(problems, transport, path, 'max_pool_connections', int, required=False, minimum=1)
+            _check_setting(problems, transport, path, 'ssm_lookup', str, required=False, choices=SSM_LOOKUPS)
+            _check_setting(problems, transport, path, 'max_concurrent_ssm_requests', int, required=False, minimum=1)
+
+    list_settings = _check_setting(problems, general, 'GENERAL', 'list', dict)
+    if list_settings is not None:
+        table_headings = _check_setting(problems, list_settings, "GENERAL['list']", 'table_headings', dict)
+
+        for heading in table_headings or {}:
+            path = "GENERAL['list']['table_headings']"
+
+            if heading not in TABLE_HEADINGS:
+                problems.append(f"{path} has an unknown heading {heading!r}. It should be one of "
+                                f"{', '.join(TABLE_HEADINGS)}")
+            else:
+                _check_setting(problems, table_headings, path, heading, bool)
+
+        _check_setting(problems, list_settings, "GENERAL['list']", 'table_renderer', str, required=False,
+                       choices=TABLE_RENDERERS)
+
+    inventory_cache = _check_setting(problems, general, 'GENERAL', 'inventory_cache', dict, required=False)
+    if inventory_cache is not None:
+        _check_setting(problems, inventory_cache, "GENERAL['inventory_cache']", 'enabled', bool, required=False)
+        _check_setting(problems, inventory_cache, "GENERAL['inventory_cache']", 'ttl_seconds', (int, float),
+                       required=False, minimum=0)
+        _check_setting(problems, inventory_cache, "GENERAL['inventory_cache']", 'max_stale_seconds', (int, float),
+                       required=False, minimum=0)
+
+    ssh_multiplexing = _check_setting(problems, general, 'GENERAL', 'ssh_multiplexing', dict, required=False)
+    if ssh_multiplexing is not None:
+        _check_setting(problems, ssh_multiplexing, "GENERAL['ssh_multiplexing']", 'enabled', bool, required=False)
+        _check_setting(problems, ssh_multiplexing, "GENERAL['ssh_multiplexing']", 'persist_seconds', int,
+                       required=False, minimum=0)
+        _check_setting(problems, ssh_multiplexing, "GENERAL['ssh_multiplexing']", 'speculative', bool,
+                       required=False)
+
+    session_manager = _check_setting(problems, general, 'GENERAL', 'session_manager', dict, required=False)
+    if session_manager is not None:
+        _check_setting(problems, session_manager, "GENERAL['session_manager']", 'use_aws_cli', bool, required=False)
+
+    routing = _check_setting(problems, general, 'GENERAL', 'routing', dict, required=False)
+    if routing is not None:
+        _check_setting(problems, routing, "GENERAL['routing']", 'enabled', bool, required=False)
+        _check_setting(problems, routing, "GENERAL['routing']", 'max_ssm_ping_age_seconds', int, required=False,
+                       minimum=0)
+        _check_setting(problems, routing, "GENERAL['routing']", 'probe_timeout_seconds', (int, float), required=False,
+                       minimum=0)
+        _check_setting(problems, routing, "GENERAL['routing']", 'bastion_latency_cache_seconds', int, required=False,
+                       minimum=0)
+
+    daemon = _check_setting(problems, general, 'GENERAL', 'daemon', dict, required=False)
+    if daemon is not None:
+        _check_setting(problems, daemon, "GENERAL['daemon']", 'enabled', bool, required=False)
+        _check_setting(problems, daemon, "GENERAL['daemon']", 'refresh_seconds', (int, float), required=False,
+                       minimum=1)
+
+    if not isinstance(bastions, list):
+        problems.append("BASTIONS is missing, or isn't a list")
+        return problems
+
+    for index, bastion in enumerate(bastions):
+        path = f"BASTIONS[{index}]"
+
+        if not isinstance(bastion, dict):
+            problems.append(f"{path} should be a dict")
+            continue
+
+        _check_setting(problems, bastion, path, 'aws_account_alias', str)
+        bastion_hosts = _check_setting(problems, bastion, path, 'bastion_host', (str, list))
+        _check_setting(problems, bastion, path, 'bastion_user', str)
+
+        if isinstance(bastion_hosts, list) and \
+                (not bastion_hosts or not all(isinstance(bastion_host, str) for bastion_host in bastion_hosts)):
+            problems.append(f"{path}['bastion_host'] should be a host, or a list of at least one host")
+        ssh_keys = _check_setting(problems, bastion, path, 'ssh_keys', (list, type(None)), required=False)
+
+        if ssh_keys is not None and not all(isinstance(ssh_key, str) for ssh_key in ssh_keys):
+            problems.append(f"{path}['ssh_keys'] should be a list of paths")
+
+    bastion_aliases = [bastion.get('aws_account_alias') for bastion in bastions if isinstance(bastion, dict)]
+    for alias in sorted({alias for alias in bastion_aliases if bastion_aliases.count(alias) > 1}, key=str):
+        problems.append(f"More than one bastion in BASTIONS is for the account alias {alias}")
+
+    return problems
+
+
+def _check_setting(problems: List[str], settings: dict, path: str, key: str, expected_type: Union[type, Tuple[type]],
+                   required: bool = True, choices: Optional[Tuple] = None, minimum: Optional[float] = None,
+                   maximum: Optional[float] = None) -> Any:
+    """
+    Check a setting has the right type and value, adding any problem with it to the problems.
+
+    :return: the setting, or None if it is missing or has a problem
+    """
+    value = settings.get(key, _MISSING)
+    setting_path = f"{path}['{key}']"
+    expected_types = expected_type if isinstance(expected_type, tuple) else (expected_type,)
+
+    if value is _MISSING:
+        if required:
+            problems.append(f"{setting_path} is missing")
+
+        return None
+
+    # True and False are also ints
+    if not isinstance(value, expected_types) or (isinstance(value, bool) and bool not in expected_types):
+        problems.append(f"{setting_path} should be "
+                        f"{' or '.join(_TYPE_DESCRIPTIONS[type_] for type_ in expected_types)}, not {value!r}")
+        return None
+
+    if choices is not None and value not in choices:
+        problems.append(f"{setting_path} should be one of {', '.join(choices)}, not {value!r}")
+        return None
+
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        limits = f"at least {minimum}" if maximum is None else f"between {minimum} and {maximum}"
+        problems.append(f"{setting_path} should be {limits}, not {value!r}")
+        return None
+
+    return value
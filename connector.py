@@ -1,38 +1,113 @@
+import hashlib
+import json
 import logging
 import os
-from typing import Optional, List
+import platform
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+from typing import Optional, List, Dict, Callable, Tuple
+
+import cache
+import timings
+
+# Commands run without a terminal, so SSH fails rather than asking for a password or to trust a host
+NON_INTERACTIVE_OPTIONS = ['-o', 'BatchMode=yes']
 
 
 class SessionManagerConnector:
     """Connect to an EC2 instance using Systems Manager Session Manager."""
 
-    def __init__(self, instance_id: str, region: str):
+    def __init__(self, instance_id: str, region: str, credentials_environment: Optional[Dict[str, str]] = None,
+                 plugin_path: Optional[str] = None, start_session: Optional[Callable[[], Tuple[dict, str]]] = None):
+        """
+        :param credentials_environment: environment variables with the credentials for the account the instance is in,
+        if they are not the current credentials
+        :param plugin_path: start the session and hand it to the Session Manager plugin at this path, rather than
+        starting it using the AWS CLI
+        :param start_session: start the session in AWS, returning the response from `start_session` and the SSM
+        endpoint it was started with. Needed when the plugin is used.
+        """
         self._logger = logging.getLogger(__name__)
         self._instance_id = instance_id
         self._region = region
+        self._credentials_environment = credentials_environment
+        self._plugin_path = plugin_path
+        self._start_session = start_session
 
-    def connect(self) -> int:
+    def connect(self, replace_process: bool = True) -> int:
+        """
+        :param replace_process: replace sessh with the session, rather than waiting for the session to end
+        """
         self._logger.debug(f"Connecting directly to {self._instance_id} using Session Manager")
+        environment = dict(os.environ)
+
+        if self._credentials_environment:
+            # A profile would be used instead of the credentials
+            environment.pop('AWS_PROFILE', None)
+            environment.pop('AWS_DEFAULT_PROFILE', None)
+            environment.update(self._credentials_environment)
+
+        if self._plugin_path is None:
+            return run_session(['aws', 'ssm', 'start-session', '--target', self._instance_id, '--region', self._region],
+                               environment, replace_process)
 
-        return os.system(f'aws ssm start-session --target "{self._instance_id}" --region "{self._region}"')
+        # The same arguments the AWS CLI passes to the plugin, without having to start the AWS CLI
+        response, endpoint_url = self._start_session()
+        self._logger.debug(f"Started session {response['SessionId']}, handing it to {self._plugin_path}")
+
+        return run_session([self._plugin_path, json.dumps(response), self._region, 'StartSession', '',
+                            json.dumps({'Target': self._instance_id}), endpoint_url],
+                           environment, replace_process, description=f"{self._plugin_path} for {response['SessionId']}")
 
 
 class SshBastionConnector:
     """Connect to an EC2 instance via a bastion, using the private IP address."""
 
-    def __init__(self, bastion_connection: str, private_ip_address: str, ssh_key_paths: Optional[List[str]]):
+    def __init__(self, bastion_connection: str, private_ip_address: str, ssh_key_paths: Optional[List[str]],
+                 control_masters: Optional['SshControlMasters'] = None):
+        """
+        :param control_masters: share the connection to the bastion between sessions, instead of connecting each time
+        """
         self._logger = logging.getLogger(__name__)
         self._bastion_connection = bastion_connection
         self._private_ip_address = private_ip_address
         self._ssh_key_paths = ssh_key_paths
+        self._control_masters = control_masters
 
-    def connect(self) -> int:
+    def connect(self, replace_process: bool = True) -> int:
+        """
+        :param replace_process: replace sessh with the session, rather than waiting for the session to end
+        """
         target = self._get_target_user_and_host()
         key_details = _get_readable_ssh_key_details(self._ssh_key_paths)
-        key_inclusion = _get_ssh_key_inclusion_argument(self._ssh_key_paths)
         self._logger.debug(f"Connecting to {target} via {self._bastion_connection} using SSH, with {key_details}")
 
-        return os.system(f'ssh {key_inclusion} -J {self._bastion_connection} {target}')
+        return run_session(self.get_arguments(), replace_process=replace_process)
+
+    def get_arguments(self, remote_command: Optional[str] = None) -> List[str]:
+        """
+        Get the SSH command line for connecting to the instance.
+
+        :param remote_command: run this command on the instance instead of starting an interactive session
+        """
+        target = self._get_target_user_and_host()
+        key_arguments = _get_ssh_key_arguments(self._ssh_key_paths)
+        options = key_arguments + (NON_INTERACTIVE_OPTIONS if remote_command else [])
+        remote_command_arguments = [remote_command] if remote_command else []
+
+        if self._control_masters is None:
+            return ['ssh'] + options + ['-J', self._bastion_connection, target] + remote_command_arguments
+
+        # -J doesn't pass options on to the connection to the bastion, so the bastion is connected to explicitly. SSH
+        # runs the proxy command using a shell.
+        proxy_command = ' '.join(shlex.quote(argument) for argument in
+                                 ['ssh'] + options + self._control_masters.get_options(self._bastion_connection) +
+                                 ['-W', '%h:%p', self._bastion_connection])
+
+        return ['ssh'] + options + ['-o', f'ProxyCommand={proxy_command}', target] + remote_command_arguments
 
     def _get_ssh_key_inclusion_argument(self):
         return f"-i {' '.join(self._ssh_key_paths)}" if self._ssh_key_paths else ''
@@ -49,26 +124,240 @@ class SshBastionConnector:
 class SshDirectConnector:
     """Connect to an EC2 instance via a bastion, using the public IP address."""
 
-    def __init__(self, public_ip_address: str, ssh_key_paths: Optional[List[str]]):
+    def __init__(self, public_ip_address: str, ssh_key_paths: Optional[List[str]],
+                 control_masters: Optional['SshControlMasters'] = None):
+        """
+        :param control_masters: share the connection to the instance between sessions, instead of connecting each time
+        """
         self._logger = logging.getLogger(__name__)
         self._public_ip_address = public_ip_address
         self._ssh_key_paths = ssh_key_paths
+        self._control_masters = control_masters
 
-    def connect(self) -> int:
+    def connect(self, replace_process: bool = True) -> int:
+        """
+        :param replace_process: replace sessh with the session, rather than waiting for the session to end
+        """
         target = self._get_target_user_and_host()
         key_details = _get_readable_ssh_key_details(self._ssh_key_paths)
-        key_inclusion = _get_ssh_key_inclusion_argument(self._ssh_key_paths)
 
         self._logger.debug(f"Connecting directly to {target} using SSH, with {key_details}")
 
-        return os.system(f'ssh {key_inclusion} {target}')
+        return run_session(self.get_arguments(), replace_process=replace_process)
+
+    def get_arguments(self, remote_command: Optional[str] = None) -> List[str]:
+        """
+        Get the SSH command line for connecting to the instance.
+
+        :param remote_command: run this command on the instance instead of starting an interactive session
+        """
+        target = self._get_target_user_and_host()
+        options = _get_ssh_key_arguments(self._ssh_key_paths) + (NON_INTERACTIVE_OPTIONS if remote_command else [])
+
+        if self._control_masters is not None:
+            options += self._control_masters.get_options(target)
+
+        return ['ssh'] + options + [target] + ([remote_command] if remote_command else [])
 
     def _get_target_user_and_host(self) -> str:
         return f'ec2-user@{self._public_ip_address}'
 
 
-def _get_ssh_key_inclusion_argument(ssh_key_paths: Optional[List[str]]) -> str:
-    return f"-i {' '.join(ssh_key_paths)}" if ssh_key_paths else ''
+class SshControlMasters:
+    """
+    SSH master connections that sessions share, so connecting to the same bastion or instance again reuses a connection
+    that has already been authenticated. Each master is kept open for a while after its last session ends.
+    """
+
+    connect_timeout_seconds = 10
+    """How long a master started in the background waits to connect, as nobody is waiting for it to fail"""
+
+    def __init__(self, directory: str, persist_seconds: int):
+        self._logger = logging.getLogger(__name__)
+        self._directory = directory
+        self._persist_seconds = persist_seconds
+        self._registry_path = os.path.join(directory, 'masters.json')
+
+    def get_options(self, destination: str) -> List[str]:
+        """Get the SSH options that start a master connection to the destination, or use the one already running."""
+        control_path = self._get_control_path(destination)
+        masters = cache.read_json_file(self._registry_path) or {}
+
+        if masters.get(control_path) != destination:
+            masters[control_path] = destination
+            cache.write_json_file(self._registry_path, masters)
+
+        return ['-o', 'ControlMaster=auto', '-o', f'ControlPath={control_path}',
+                '-o', f'ControlPersist={self._persist_seconds}s']
+
+    def is_running(self, destination: str) -> bool:
+        return os.path.exists(self._get_control_path(destination))
+
+    def start(self, destination: str, ssh_key_paths: Optional[List[str]]) -> subprocess.Popen:
+        """
+        Start a master connection to the destination without a session, in the background. SSH exits once it has
+        connected and authenticated, leaving the master connection running.
+        """
+        arguments = ['ssh'] + _get_ssh_key_arguments(ssh_key_paths) + NON_INTERACTIVE_OPTIONS + \
+            ['-o', f'ConnectTimeout={self.connect_timeout_seconds}'] + self.get_options(destination) + \
+            ['-f', '-N', destination]
+        self._logger.debug(f"Starting a shared SSH connection to {destination}")
+
+        return subprocess.Popen(arguments, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+
+    def status(self) -> Dict[str, Optional[str]]:
+        """Get the status reported by SSH for each master connection that is running, by destination."""
+        return {destination: self._run_control_command('check', control_path, destination)
+                for control_path, destination in self._get_running_masters().items()}
+
+    def stop(self) -> List[str]:
+        """Stop every master connection, including any sessions using them. Returns the destinations stopped."""
+        stopped = []
+
+        for control_path, destination in self._get_running_masters().items():
+            self._run_control_command('exit', control_path, destination)
+            stopped.append(destination)
+
+        cache.write_json_file(self._registry_path, {})
+
+        return stopped
+
+    def stop_master(self, destination: str):
+        """Stop the master connection to the destination, including any sessions using it."""
+        self._run_control_command('exit', self._get_control_path(destination), destination)
+
+    def _get_running_masters(self) -> Dict[str, str]:
+        masters = cache.read_json_file(self._registry_path) or {}
+
+        return {control_path: destination for control_path, destination in masters.items()
+                if os.path.exists(control_path)}
+
+    def _get_control_path(self, destination: str) -> str:
+        # Sockets have a short maximum path length, so the destination is hashed rather than used in the file name
+        return os.path.join(self._directory, hashlib.sha1(destination.encode()).hexdigest()[:16])
+
+    def _run_control_command(self, command: str, control_path: str, destination: str) -> Optional[str]:
+        result = subprocess.run(['ssh', '-O', command, '-o', f'ControlPath={control_path}', destination],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        self._logger.debug(f"ssh -O {command} for {destination}: {result.stdout.strip()}")
+
+        return result.stdout.strip() if result.returncode == 0 else None
+
+
+class SpeculativeSshMaster:
+    """
+    Starts the shared SSH connection to a bastion in the background, before sessh knows whether it will be needed, so
+    connecting and authenticating happens while the instance is looked up rather than after.
+    """
+
+    def __init__(self, control_masters: SshControlMasters,
+                 get_bastion: Callable[[], Optional[Tuple[str, Optional[List[str]]]]]):
+        """
+        :param get_bastion: get the bastion to connect to, and the SSH keys for it, or None if there isn't one
+        """
+        self._logger = logging.getLogger(__name__)
+        self._control_masters = control_masters
+        self._lock = threading.Lock()
+        self._destination: Optional[str] = None
+        self._process: Optional[subprocess.Popen] = None
+        self._dropped = False
+        self._thread = threading.Thread(target=self._start, args=(get_bastion,), name='speculative-ssh-master',
+                                        daemon=True)
+        self._thread.start()
+
+    def wait(self, destination: Optional[str]):
+        """
+        Wait for the connection to the bastion to be ready, if it is the one being connected to. Otherwise it isn't
+        needed, so it is dropped.
+
+        :param destination: the bastion being connected to, or None if the instance is connected to without one
+        """
+        self._thread.join()
+
+        with self._lock:
+            process = self._process if self._destination == destination else None
+
+        if process is None:
+            self.drop()
+        else:
+            with timings.span('wait for speculative SSH connection', destination=destination):
+                exit_code = process.wait()
+            self._logger.debug(f"Speculative SSH connection to {destination} exited with {exit_code}")
+
+    def drop(self):
+        """
+        Stop connecting to the bastion, as it isn't needed. A connection that is already ready is stopped too, rather
+        than being left open on the bastion until it expires.
+        """
+        with self._lock:
+            self._dropped = True
+
+            if self._process is None:
+                return
+
+            if self._process.poll() is None:
+                self._logger.debug(f"Abandoning the speculative SSH connection to {self._destination}")
+                self._process.terminate()
+            elif self._process.returncode == 0:
+                # SSH exits once it has authenticated, leaving the master connection it started running
+                self._logger.debug(f"Stopping the speculative SSH connection to {self._destination}")
+                self._control_masters.stop_master(self._destination)
+
+    def _start(self, get_bastion: Callable[[], Optional[Tuple[str, Optional[List[str]]]]]):
+        try:
+            bastion = get_bastion()
+        except Exception as e:
+            # sessh connects to the bastion as usual if it is needed
+            self._logger.debug(f"Unable to find the bastion to connect to speculatively: {e}")
+            return
+
+        if bastion is None:
+            return
+
+        destination, ssh_key_paths = bastion
+        with self._lock:
+            if self._dropped or self._control_masters.is_running(destination):
+                return
+
+            self._destination = destination
+            self._process = self._control_masters.start(destination, ssh_key_paths)
+
+
+def run_session(arguments: List[str], environment: Optional[Dict[str, str]] = None,
+                replace_process: bool = True, description: Optional[str] = None) -> int:
+    """
+    Start the session. sessh is replaced by the session when possible, so it doesn't stay in memory until the session
+    ends.
+
+    :param environment: the environment variables for the session, instead of the ones sessh has
+    :param replace_process: replace sessh with the session. On Windows sessh always waits for the session to end.
+    :param description: what to log instead of the arguments, when they include secrets like session tokens
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug(f"Running {description or ' '.join(shlex.quote(argument) for argument in arguments)}")
+
+    if replace_process and platform.system() != 'Windows':
+        # The timings can't be reported once sessh has been replaced, so they are reported now
+        timings.report()
+        # Anything still buffered would be lost when sessh is replaced
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execvpe(arguments[0], arguments, environment if environment is not None else os.environ)
+
+    session = subprocess.Popen(arguments, env=environment)
+    # Ctrl+C is for the session, so sessh has to ignore it until the session ends
+    previous_interrupt_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    try:
+        with timings.span('session', command=arguments[0]):
+            return session.wait()
+    finally:
+        signal.signal(signal.SIGINT, previous_interrupt_handler)
+
+
+def _get_ssh_key_arguments(ssh_key_paths: Optional[List[str]]) -> List[str]:
+    return [argument for ssh_key_path in ssh_key_paths or [] for argument in ('-i', ssh_key_path)]
 
 
 def _get_readable_ssh_key_details(ssh_key_paths: Optional[List[str]]) -> str:
@@ -0,0 +1,264 @@
+import logging
+import os
+import socketserver
+import threading
+import time
+from functools import partial
+from typing import List, Dict, Optional, Tuple
+
+import boto3
+
+import aws
+import daemon_client
+import inventory
+from instances import Instance, InstancesRepository
+
+# The account ID and region of some instances
+InstancesKey = Tuple[str, str]
+
+
+class InventoryDaemon:
+    """
+    Keeps the instances for each account and region sessh has been asked about in memory, with warm AWS clients, and
+    refreshes them on a schedule. `list` and `connect` ask it for instances over a Unix domain socket instead of loading
+    them themselves.
+    """
+
+    account_sessions_lifetime_seconds = 45 * 60
+    """Assumed roles expire after an hour, so the sessions for other accounts are created again before then"""
+
+    def __init__(self, instances_inventory: inventory.Inventory, socket_path: str, region: str,
+                 refresh_seconds: int):
+        """
+        :param region: the default region, which requests have to be for, along with the daemon's own credentials
+        """
+        self._logger = logging.getLogger(__name__)
+        self._inventory = instances_inventory
+        self._socket_path = socket_path
+        self._region = region
+        self._credentials_identity = daemon_client.get_credentials_identity()
+        self._refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server: Optional[socketserver.UnixStreamServer] = None
+
+        self._regions: Dict[Tuple[Optional[str], bool], List[str]] = {}
+        """The regions for each --regions and --all-regions, which rarely change"""
+        self._account_sessions: Dict[Tuple[Optional[str], bool], Tuple[float, inventory.AccountSessions]] = {}
+        """When the sessions were created, and the sessions, for each --accounts and --all-accounts"""
+        self._account_ids: Dict[Optional[boto3.Session], str] = {}
+        self._instances: Dict[InstancesKey, InstancesRepository] = {}
+        self._sessions: Dict[InstancesKey, Optional[boto3.Session]] = {}
+        """The session each account and region's instances are fetched with"""
+        self._combined_instances: Dict[Tuple[InstancesKey, ...], InstancesRepository] = {}
+        """The instances for the accounts and regions in each request, so they are only sorted and indexed once"""
+
+    def serve(self) -> int:
+        """Answer requests until the daemon is stopped."""
+        if daemon_client.DaemonClient(self._socket_path, self._region).request({'action': 'status'}) is not None:
+            print(f"sessh daemon is already running, listening on {self._socket_path}")
+            return 1
+
+        os.makedirs(os.path.dirname(self._socket_path), exist_ok=True, mode=0o700)
+        # Left behind by a daemon that didn't stop cleanly
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+
+        self._server = _Server(self._socket_path, self)
+        os.chmod(self._socket_path, 0o600)
+        threading.Thread(target=self._refresh_periodically, name='daemon-refresh', daemon=True).start()
+        print(f"sessh daemon is listening on {self._socket_path}, refreshing instances every {self._refresh_seconds}s")
+
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopped.set()
+            self._server.server_close()
+            os.remove(self._socket_path)
+
+        return 0
+
+    def handle(self, request: dict) -> dict:
+        action = request.get('action')
+
+        if action == 'status':
+            with self._lock:
+                return {'pid': os.getpid(), 'refresh_seconds': self._refresh_seconds,
+                        'instances': sum(len(instances.all()) for instances in self._instances.values()),
+                        'regions': sorted(f'{account_id} {region}' for account_id, region in self._instances)}
+
+        if action == 'stop':
+            # Shutting down waits for the server to stop, which can't happen while it is handling this request
+            threading.Thread(target=self._server.shutdown, name='daemon-stop').start()
+            return {'pid': os.getpid()}
+
+        # The instances and sessions are for the daemon's own default region and credentials, so sessh finds the
+        # instances itself when it is run with different ones
+        if request.get('region') != self._region:
+            return {'unavailable': f"the request is for region {request.get('region')}, not {self._region}"}
+        if request.get('credentials') != self._credentials_identity:
+            return {'unavailable': "the request is for different AWS credentials"}
+
+        if action == 'list':
+            instances, regions, number_accounts = self._get_instances(request)
+
+            return {'instances': [instance.to_dict() for instance in instances.running()], 'regions': regions,
+                    'number_accounts': number_accounts}
+
+        if action == 'lookup':
+            instances, regions, number_accounts = self._get_instances(request)
+
+            return {'instances': [instance.to_dict() for instance in instances.find_running(request['name_or_id'])],
+                    'regions': regions, 'number_accounts': number_accounts}
+
+        if action == 'check':
+            return self._check(Instance.from_dict(request['instance']))
+
+        if action == 'start_session':
+            instance = Instance.from_dict(request['instance'])
+            with self._lock:
+                session = self._sessions.get((instance.account_id, instance.region))
+
+            response, endpoint_url = aws.start_session(instance.instance_id, instance.region, session)
+
+            return {'response': response, 'endpoint_url': endpoint_url}
+
+        raise ValueError(f"sessh daemon doesn't know how to {action}")
+
+    def _get_instances(self, request: dict) -> Tuple[InstancesRepository, List[str], int]:
+        """Get the running instances for the regions and accounts in the request, loading any it doesn't have yet."""
+        regions = self._get_regions(request.get('regions'), request.get('all_regions', False))
+        account_sessions = self._get_account_sessions(request.get('accounts'), request.get('all_accounts', False))
+        sessions = {}
+
+        for session in account_sessions.values():
+            account_id = self._get_account_id(session)
+
+            for region in regions:
+                sessions[(account_id, region)] = session
+
+        with self._lock:
+            self._sessions.update(sessions)
+            keys_to_load = [key for key in sessions if request.get('refresh') or key not in self._instances]
+
+        self._load(keys_to_load, refresh=bool(request.get('refresh')))
+
+        keys = tuple(sorted(sessions))
+        with self._lock:
+            if keys not in self._combined_instances:
+                self._combined_instances[keys] = InstancesRepository(
+                    [instance for key in keys for instance in self._instances[key].all()])
+
+            return self._combined_instances[keys], regions, len(account_sessions)
+
+    def _get_regions(self, regions_argument: Optional[str], all_regions: bool) -> List[str]:
+        key = (regions_argument, all_regions)
+
+        if key not in self._regions:
+            self._regions[key] = self._inventory.get_regions(regions_argument, all_regions)
+
+        return self._regions[key]
+
+    def _get_account_sessions(self, accounts_argument: Optional[str], all_accounts: bool) -> inventory.AccountSessions:
+        key = (accounts_argument, all_accounts)
+
+        with self._lock:
+            created_at, account_sessions = self._account_sessions.get(key, (0, None))
+
+        if time.time() - created_at < self.account_sessions_lifetime_seconds:
+            return account_sessions
+
+        new_account_sessions = self._inventory.get_account_sessions(accounts_argument, all_accounts)
+
+        with self._lock:
+            self._account_sessions[key] = (time.time(), new_account_sessions)
+
+            # Instances are refreshed using the new sessions from now on
+            for instances_key, session in self._sessions.items():
+                if session is not None and instances_key[0] in new_account_sessions:
+                    self._sessions[instances_key] = new_account_sessions[instances_key[0]]
+
+        for session in (account_sessions or {}).values():
+            if session is not None:
+                aws.discard_clients(session)
+                self._account_ids.pop(session, None)
+
+        return new_account_sessions
+
+    def _get_account_id(self, session: Optional[boto3.Session]) -> str:
+        if session not in self._account_ids:
+            self._account_ids[session] = self._inventory.get_account_id(session)
+
+        return self._account_ids[session]
+
+    def _load(self, keys: List[InstancesKey], refresh: bool):
+        with self._lock:
+            sessions = {key: self._sessions[key] for key in keys}
+
+        results = aws.run_concurrently("instances for the daemon", {
+            key: partial(self._inventory.load_instances, refresh, [key[1]], session, key[0])
+            for key, session in sessions.items()
+        })
+
+        with self._lock:
+            self._instances.update(results)
+
+            if results:
+                self._combined_instances.clear()
+
+    def _refresh_periodically(self):
+        while not self._stopped.wait(self._refresh_seconds):
+            with self._lock:
+                keys = list(self._instances)
+                account_arguments = list(self._account_sessions)
+
+            try:
+                # Replace any sessions that are about to expire
+                for accounts_argument, all_accounts in account_arguments:
+                    self._get_account_sessions(accounts_argument, all_accounts)
+
+                self._load(keys, refresh=True)
+                self._logger.debug(f"Refreshed the instances for {len(keys)} accounts and regions")
+            except Exception as e:
+                # The instances already in memory are still used, and refreshed again next time
+                self._logger.warning(f"Unable to refresh the instances: {e}")
+
+    def _check(self, instance: Instance) -> dict:
+        """
+        Check the instance is still running before connecting to it, and get its current IP addresses and the
+        credentials for its account.
+        """
+        with self._lock:
+            session = self._sessions.get((instance.account_id, instance.region))
+
+        metadata = aws.get_running_instance_metadata(instance.instance_id, instance.region, session)
+
+        return {'running': metadata is not None,
+                'public_ip': metadata.public_ip if metadata else None,
+                'private_ip': metadata.private_ip if metadata else None,
+                'credentials_environment': aws.get_credentials_environment(session)}
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        request = daemon_client.receive_message(self.request)
+        if request is None:
+            return
+
+        try:
+            response = self.server.inventory_daemon.handle(request)
+        except Exception as e:
+            logging.getLogger(__name__).debug(f"Unable to {request.get('action')}", exc_info=True)
+            response = {'error': str(e)}
+
+        daemon_client.send_message(self.request, response)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, inventory_daemon: InventoryDaemon):
+        self.inventory_daemon = inventory_daemon
+        super().__init__(socket_path, _RequestHandler)
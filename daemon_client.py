@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import socket
+from typing import Optional
+
+import cache
+
+# Long enough for the daemon to fetch instances it doesn't have yet, but not so long that a stuck daemon stops sessh
+# falling back to looking the instances up itself
+CONNECT_TIMEOUT_SECONDS = 1
+RESPONSE_TIMEOUT_SECONDS = 60
+
+
+def is_supported() -> bool:
+    """Unix domain sockets aren't available on every platform, like Windows."""
+    return hasattr(socket, 'AF_UNIX')
+
+
+def send_message(connection: socket.socket, message: dict):
+    connection.sendall(json.dumps(message).encode() + b'\n')
+
+
+def receive_message(connection: socket.socket) -> Optional[dict]:
+    """Receive a message, which is a line of JSON, or None if the connection was closed without one."""
+    with connection.makefile('rb') as connection_file:
+        line = connection_file.readline()
+
+    return json.loads(line) if line else None
+
+
+def get_credentials_identity() -> dict:
+    """
+    Identify the credentials AWS will be called with, without resolving them, which needs boto3. Credentials in the
+    environment are identified by the same fingerprint as in the identity cache, and others by the profile and
+    configuration files they are read from.
+    """
+    access_key = os.environ.get('AWS_ACCESS_KEY_ID')
+
+    return {'access_key': cache.get_access_key_fingerprint(access_key) if access_key else None,
+            'profile': os.environ.get('AWS_PROFILE') or os.environ.get('AWS_DEFAULT_PROFILE'),
+            'config_files': [os.environ.get('AWS_CONFIG_FILE'), os.environ.get('AWS_SHARED_CREDENTIALS_FILE')]}
+
+
+class DaemonClient:
+    """Asks `sessh daemon` for the instances it has in memory, over its Unix domain socket."""
+
+    fallback_actions = ('list', 'lookup', 'check')
+    """What sessh does itself when the daemon can't, so the daemon failing to do them isn't an error"""
+
+    def __init__(self, socket_path: str, region: str):
+        """
+        :param region: the default region, which the daemon only answers for if it is also its own
+        """
+        self._logger = logging.getLogger(__name__)
+        self._socket_path = socket_path
+        self._region = region
+
+    def request(self, request: dict) -> Optional[dict]:
+        """
+        Send a request to the daemon, with the region and credentials it is for.
+
+        :return: the daemon's response, or None if the daemon isn't running, didn't respond in time, uses a different
+        region or credentials, or failed to do something sessh can do itself
+        """
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.settimeout(CONNECT_TIMEOUT_SECONDS)
+                connection.connect(self._socket_path)
+                connection.settimeout(RESPONSE_TIMEOUT_SECONDS)
+                send_message(connection, {**request, 'region': self._region,
+                                          'credentials': get_credentials_identity()})
+                response = receive_message(connection)
+        except (OSError, ValueError) as e:
+            self._logger.debug(f"Unable to ask the daemon at {self._socket_path} to {request['action']}: {e}")
+            return None
+
+        if response is not None and 'error' in response:
+            if request['action'] not in self.fallback_actions:
+                raise RuntimeError(response['error'])
+
+            self._logger.debug(f"The daemon at {self._socket_path} was unable to {request['action']}: "
+                               f"{response['error']}")
+            return None
+
+        if response is not None and 'unavailable' in response:
+            self._logger.debug(f"The daemon at {self._socket_path} can't {request['action']}: "
+                               f"{response['unavailable']}")
+            return None
+
+        return response
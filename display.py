@@ -0,0 +1,238 @@
+import abc
+import csv
+import json
+import shutil
+import sys
+import threading
+from functools import partial
+from typing import List, Dict, Optional, TextIO, Callable, Any
+
+from instances import Instance
+
+
+class InstancesDisplayer:
+    header_mappings = {
+        'Name': lambda i: i.name,
+        'Instance ID': lambda i: i.instance_id,
+        'Launch time': lambda i: i.launch_time,
+        'Private IP': lambda i: i.private_ip,
+        'Public IP': lambda i: i.public_ip,
+        'Connection type': lambda i: i.connection_details(),
+        'Region': lambda i: i.region,
+        'Account': lambda i: i.account_id,
+    }
+    """Maps the table column heading to a lambda that returns the relevant value from the Instance"""
+
+    def __init__(self, table_column_configuration: dict, account_aliases: Optional[Dict[str, str]] = None,
+                 renderer: str = 'fast', output: TextIO = sys.stdout):
+        """
+        :param account_aliases: the aliases to show in the Account column, by account ID
+        :param renderer: draw tables with sessh's own renderer, which is quick for thousands of instances, or texttable,
+        which wraps values to fit the terminal
+        """
+        self._table_column_configuration = table_column_configuration
+        self._account_aliases = account_aliases or {}
+        self._renderer = renderer
+        self._output = output
+
+    def display(self, instances: List[Instance]):
+        headers = self.get_chosen_headers()
+        extractors = self.get_value_extractors(headers)
+
+        self._draw(headers, [[extractor(instance) for extractor in extractors] for instance in instances])
+
+    def _draw(self, headers: List[str], rows: List[list]):
+        if self._renderer == 'texttable':
+            # texttable is only imported when it is used
+            import texttable as tt
+
+            # Make the table at least 120 columns wide, but bigger if the terminal is currently wider.
+            terminal_columns = shutil.get_terminal_size().columns
+            table = tt.Texttable(max(terminal_columns, 120))
+            table.header(headers)
+            table.add_rows(rows, header=False)
+            print(table.draw(), file=self._output)
+        else:
+            TableRenderer(self._output).draw(headers, [[str(value) for value in row] for row in rows])
+
+    def get_chosen_headers(self) -> List[str]:
+        """Get the headers that have been chosen by the user in the configuration file."""
+        chosen_headers = []
+
+        for header, is_chosen in self._table_column_configuration.items():
+            if is_chosen:
+                chosen_headers.append(header)
+
+        return chosen_headers
+
+    def get_value_extractors(self, chosen_headers: List[str]) -> List[Callable[[Instance], Any]]:
+        """Get the function that returns the value for each header from an instance, so they are only looked up once."""
+        return [partial(self.get_instance_value_for_header, 'Account') if header_name == 'Account'
+                else self.header_mappings[header_name]
+                for header_name in chosen_headers]
+
+    def get_instance_value_for_header(self, header_name, instance: Instance) -> Optional[str]:
+        if header_name == 'Account':
+            return self._account_aliases.get(instance.account_id, instance.account_id)
+
+        return self.header_mappings[header_name](instance)
+
+    def display_indexed(self, instances: List[Instance]):
+        headers = self.get_chosen_headers()
+        extractors = self.get_value_extractors(headers)
+
+        # Add a # as the first column so a user can choose the instance they want to connect to
+        self._draw(['#'] + headers, [[str(index)] + [extractor(instance) for extractor in extractors]
+                                     for index, instance in enumerate(instances)])
+
+
+class TableRenderer:
+    """
+    Draws tables that look like texttable's, but quickly enough for tens of thousands of rows. Each column is as wide as
+    its widest value rather than being wrapped to fit the terminal.
+    """
+
+    rows_per_write = 1000
+
+    def __init__(self, output: TextIO = sys.stdout):
+        self._output = output
+
+    def draw(self, headers: List[str], rows: List[List[str]]):
+        widths = [max(len(header), max(map(len, column), default=0))
+                  for header, column in zip(headers, zip(*rows) if rows else [[]] * len(headers))]
+
+        separator = '+' + '+'.join('-' * (width + 2) for width in widths) + '+\n'
+        line_template = '| ' + ' | '.join(f'{{:<{width}}}' for width in widths) + ' |\n'
+        row_template = line_template + separator
+        centred_headers = [' ' * ((width - len(header)) // 2) + header for header, width in zip(headers, widths)]
+
+        self._output.write(separator + line_template.format(*centred_headers) + separator.replace('-', '='))
+
+        # Rows are written a chunk at a time, rather than one at a time or all at once
+        for chunk_start in range(0, len(rows), self.rows_per_write):
+            self._output.write(''.join(row_template.format(*row)
+                                       for row in rows[chunk_start:chunk_start + self.rows_per_write]))
+
+        self._output.flush()
+
+
+class InstancesWriter(abc.ABC):
+    """
+    Writes instances as soon as they have been fetched, rather than waiting for all of them. Instances can be written
+    from more than one thread at the same time.
+    """
+
+    def __init__(self, output: TextIO = sys.stdout):
+        self._output = output
+        self._lock = threading.Lock()
+
+    def write(self, instances: List[Instance]):
+        with self._lock:
+            self._write_instances(instances)
+            self._output.flush()
+
+    def close(self):
+        self._output.flush()
+
+    @abc.abstractmethod
+    def _write_instances(self, instances: List[Instance]):
+        pass
+
+
+class JsonInstancesWriter(InstancesWriter):
+    """Writes a JSON array of instances."""
+
+    def __init__(self, output: TextIO = sys.stdout):
+        super().__init__(output)
+        self._started = False
+
+    def _write_instances(self, instances: List[Instance]):
+        for instance in instances:
+            self._output.write(',\n' if self._started else '[\n')
+            self._output.write(json.dumps(instance.to_dict()))
+            self._started = True
+
+    def close(self):
+        self._output.write('\n]\n' if self._started else '[]\n')
+        super().close()
+
+
+class NdjsonInstancesWriter(InstancesWriter):
+    """Writes each instance as a JSON object on its own line."""
+
+    def _write_instances(self, instances: List[Instance]):
+        for instance in instances:
+            self._output.write(json.dumps(instance.to_dict()) + '\n')
+
+
+class DelimitedInstancesWriter(InstancesWriter):
+    """Writes the instances as CSV, or TSV, with a header row."""
+
+    def __init__(self, delimiter: str, output: TextIO = sys.stdout):
+        super().__init__(output)
+        self._writer = None
+        self._delimiter = delimiter
+
+    def _write_instances(self, instances: List[Instance]):
+        for instance in instances:
+            row = instance.to_dict()
+
+            if self._writer is None:
+                self._writer = csv.DictWriter(self._output, fieldnames=list(row), delimiter=self._delimiter,
+                                              lineterminator='\n')
+                self._writer.writeheader()
+
+            self._writer.writerow(row)
+
+
+class StreamingTableWriter(InstancesWriter):
+    """
+    Writes the instances in columns as they are fetched. The widths of the columns can't be worked out from the
+    instances before they are written, so values wider than their column push the rest of the row along.
+    """
+
+    column_widths = {
+        'Name': 40,
+        'Instance ID': 19,
+        'Launch time': 25,
+        'Private IP': 15,
+        'Public IP': 15,
+        'Connection type': 24,
+        'Region': 14,
+        'Account': 20,
+    }
+
+    def __init__(self, displayer: InstancesDisplayer, output: TextIO = sys.stdout):
+        super().__init__(output)
+        self._displayer = displayer
+        self._headers = displayer.get_chosen_headers()
+        self._extractors = displayer.get_value_extractors(self._headers)
+        self._write_row(self._headers)
+
+    def _write_instances(self, instances: List[Instance]):
+        for instance in instances:
+            self._write_row([extractor(instance) for extractor in self._extractors])
+
+    def _write_row(self, values: list):
+        columns = [str(value if value is not None else '').ljust(self.column_widths.get(header, 20))
+                   for header, value in zip(self._headers, values)]
+        self._output.write('  '.join(columns).rstrip() + '\n')
+
+
+def create_instances_writer(output_format: str, displayer: InstancesDisplayer) -> InstancesWriter:
+    if output_format == 'json':
+        return JsonInstancesWriter()
+
+    if output_format == 'ndjson':
+        return NdjsonInstancesWriter()
+
+    if output_format == 'csv':
+        return DelimitedInstancesWriter(',')
+
+    if output_format == 'tsv':
+        return DelimitedInstancesWriter('\t')
+
+    if output_format == 'stream':
+        return StreamingTableWriter(displayer)
+
+    raise RuntimeError(f"Unknown output format {output_format}")
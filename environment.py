@@ -1,5 +1,24 @@
+import logging
+import os
 import platform
+import shutil
 import subprocess
+import sys
+import time
+from typing import List, Optional
+
+import cache
+
+REFRESH_INVENTORY_CACHE_COMMAND = 'refresh-inventory-cache'
+"""The hidden command list and connect run in a separate process to refresh a stale inventory cache"""
+
+
+def get_sessh_command() -> List[str]:
+    """Get the command that runs sessh, which is the executable itself when it has been bundled by PyInstaller."""
+    if getattr(sys, 'frozen', False):
+        return [sys.executable]
+
+    return [sys.executable, os.path.abspath(sys.argv[0])]
 
 
 class Checker:
@@ -15,41 +34,87 @@ class Checker:
     def running_on_linux() -> bool:
         return platform.system() == 'Linux'
 
-    @staticmethod
-    def aws_cli_tools_installed_on_macos_or_linux() -> bool:
-        return subprocess.run(['command', '-v', 'aws'], capture_output=True).returncode == 0
+    def is_running_on_supported_os(self) -> bool:
+        return self.running_on_macos() or self.running_on_windows() or self.running_on_linux()
 
-    @staticmethod
-    def aws_cli_session_manager_plugin_installed_on_macos_or_linux() -> bool:
-        return subprocess.run(['command', '-v', 'session-manager-plugin'], capture_output=True).returncode == 0
 
-    @staticmethod
-    def aws_cli_tools_installed_on_windows() -> bool:
-        return subprocess.run(['where', 'aws'], capture_output=True).returncode == 0
+class Tool:
+    def __init__(self, name: str, path: Optional[str], version: Optional[str] = None, from_cache: bool = False,
+                 resolve_seconds: float = 0.0):
+        self.name = name
+        self.path = path
+        self.version = version
+        self.from_cache = from_cache
+        self.resolve_seconds = resolve_seconds
+
+    def is_installed(self) -> bool:
+        return self.path is not None
 
-    @staticmethod
-    def aws_cli_session_manager_plugin_installed_on_windows() -> bool:
-        return subprocess.run(['where', 'session-manager-plugin'], capture_output=True).returncode == 0
+
+class ToolFinder:
+    """
+    Finds the command line tools sessh uses on the PATH without starting a shell. Where each tool was found, and its
+    version, is remembered between runs until the PATH or the tool changes.
+    """
+
+    # Arguments for tools that don't output their version with --version
+    version_arguments = {'ssh': ['-V']}
+
+    def __init__(self, tool_cache: Optional[cache.ToolCache] = None):
+        self._logger = logging.getLogger(__name__)
+        self._tool_cache = tool_cache
 
     def aws_cli_tools_installed(self) -> bool:
-        if self.running_on_macos() or self.running_on_linux():
-            return self.aws_cli_tools_installed_on_macos_or_linux()
-        if self.running_on_windows():
-            return self.aws_cli_tools_installed_on_windows()
+        return self.find('aws').is_installed()
 
-        print("Unable to determine the operating system for your computer. I support Linux, macOS, and Windows.")
+    def find(self, name: str, include_version: bool = False, refresh: bool = False) -> Tool:
+        """
+        :param include_version: run the tool to find out its version, if it isn't already known
+        :param refresh: ignore where the tool was found before
+        """
+        started = time.perf_counter()
+        cached_tool = self._tool_cache.get(name) if self._tool_cache and not refresh else None
 
-        return False
+        if cached_tool and _is_unchanged(cached_tool) and (cached_tool['version'] or not include_version):
+            tool = Tool(name, cached_tool['path'], cached_tool['version'], from_cache=True)
+        else:
+            path = shutil.which(name)
+            tool = Tool(name, path, self._get_version(name, path) if path and include_version else None)
+
+            # Tools that aren't found aren't remembered, so they are found as soon as they are installed
+            if path and self._tool_cache:
+                self._tool_cache.save(name, {
+                    'path': path,
+                    'version': tool.version,
+                    'path_variable': os.environ.get('PATH', ''),
+                    'modified_at': os.stat(path).st_mtime,
+                })
+
+        tool.resolve_seconds = time.perf_counter() - started
+        self._logger.debug(f"Found {name} at {tool.path} in {tool.resolve_seconds * 1000:.1f}ms"
+                           f"{' from the tool cache' if tool.from_cache else ''}")
 
-    def aws_cli_session_manager_plugin_installed(self) -> bool:
-        if self.running_on_macos() or self.running_on_linux():
-            return self.aws_cli_session_manager_plugin_installed_on_macos_or_linux()
-        if self.running_on_windows():
-            return self.aws_cli_session_manager_plugin_installed_on_windows()
+        return tool
 
-        print("Unable to determine the operating system for your computer. I support Linux, macOS, and Windows.")
+    def _get_version(self, name: str, path: str) -> Optional[str]:
+        try:
+            result = subprocess.run([path] + self.version_arguments.get(name, ['--version']), stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, universal_newlines=True, timeout=10)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            self._logger.debug(f"Unable to get the version of {name}: {e}")
+            return None
 
+        lines = result.stdout.strip().splitlines()
+
+        return lines[0] if lines else None
+
+
+def _is_unchanged(cached_tool: dict) -> bool:
+    """Whether the tool would still be found in the same place, and hasn't been upgraded."""
+    if cached_tool['path_variable'] != os.environ.get('PATH', ''):
         return False
 
-    def is_running_on_supported_os(self) -> bool:
-        return self.running_on_macos() or self.running_on_windows() or self.running_on_linux()
+    try:
+        return os.stat(cached_tool['path']).st_mtime == cached_tool['modified_at']
+    except OSError:
+        return False
@@ -0,0 +1,190 @@
+import logging
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Optional, Union
+
+import boto3
+from botocore.exceptions import ClientError
+
+import aws
+import connector
+from instances import Instance
+
+SshConnector = Union[connector.SshBastionConnector, connector.SshDirectConnector]
+
+
+class CommandResult:
+    def __init__(self, instance: Instance, exit_code: int, status: str):
+        self.instance = instance
+        self.exit_code = exit_code
+        self.status = status
+
+    def succeeded(self) -> bool:
+        return self.exit_code == 0
+
+
+class OutputPrinter:
+    """Prints output from many instances at the same time, with each line prefixed by the instance it came from."""
+
+    def __init__(self, instances: List[Instance]):
+        self._lock = threading.Lock()
+        self._prefix_width = max((len(get_instance_label(instance)) for instance in instances), default=0)
+
+    def print_line(self, instance: Instance, line: str):
+        with self._lock:
+            print(f"{get_instance_label(instance):<{self._prefix_width}} | {line}", flush=True)
+
+
+class SshCommandExecutor:
+    """Runs a command on instances using SSH, printing the output from each as it arrives."""
+
+    def __init__(self, connectors: Dict[str, Tuple[Instance, SshConnector]], output_printer: OutputPrinter,
+                 max_concurrency: int, timeout_seconds: int):
+        """
+        :param connectors: the instance and its SSH connector, by instance ID
+        :param max_concurrency: the most SSH processes to run at the same time
+        :param timeout_seconds: stop SSH if the command hasn't finished on the instance within this long
+        """
+        self._logger = logging.getLogger(__name__)
+        self._connectors = connectors
+        self._output_printer = output_printer
+        self._max_concurrency = max_concurrency
+        self._timeout_seconds = timeout_seconds
+
+    def run(self, command: str) -> List[CommandResult]:
+        if not self._connectors:
+            return []
+
+        with ThreadPoolExecutor(max_workers=self._max_concurrency, thread_name_prefix='ssh-command') as executor:
+            return list(executor.map(lambda instance_connector: self._run_on_instance(command, *instance_connector),
+                                     self._connectors.values()))
+
+    def _run_on_instance(self, command: str, instance: Instance, ssh_connector: SshConnector) -> CommandResult:
+        arguments = ssh_connector.get_arguments(command)
+        self._logger.debug(f"Running {arguments} for {instance.instance_id}")
+
+        process = subprocess.Popen(arguments, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, universal_newlines=True, errors='replace')
+        timed_out = threading.Event()
+
+        def stop():
+            timed_out.set()
+            process.kill()
+
+        # The output is read until SSH exits, so it is stopped from another thread
+        timeout = threading.Timer(self._timeout_seconds, stop)
+        timeout.start()
+
+        try:
+            for line in process.stdout:
+                self._output_printer.print_line(instance, line.rstrip('\n'))
+
+            exit_code = process.wait()
+        finally:
+            timeout.cancel()
+
+        if timed_out.is_set() and exit_code != 0:
+            self._output_printer.print_line(instance, f"Timed out after {self._timeout_seconds}s")
+            return CommandResult(instance, -1, 'TimedOut')
+
+        return CommandResult(instance, exit_code, 'Success' if exit_code == 0 else 'Failed')
+
+
+class SessionManagerCommandExecutor:
+    """
+    Runs a command on instances using Systems Manager Run Command. The command is sent to batches of instances, then
+    the output from each instance is printed as soon as the command has finished on it.
+    """
+
+    def __init__(self, instances: List[Instance], account_sessions: Dict[Optional[str], Optional[boto3.Session]],
+                 output_printer: OutputPrinter, max_concurrency: int, timeout_seconds: int,
+                 poll_interval_seconds: float = 2):
+        """
+        :param account_sessions: the session for the account of each instance, by account ID
+        :param max_concurrency: the most instances to run the command on at the same time, for each batch
+        :param timeout_seconds: stop waiting for the command if it hasn't finished on an instance within this long
+        """
+        self._logger = logging.getLogger(__name__)
+        self._instances = instances
+        self._account_sessions = account_sessions
+        self._output_printer = output_printer
+        self._max_concurrency = max_concurrency
+        self._timeout_seconds = timeout_seconds
+        self._poll_interval_seconds = poll_interval_seconds
+
+    def run(self, command: str) -> List[CommandResult]:
+        results = []
+        # The client and the instances it is still running on, by command ID
+        running_commands: Dict[str, Tuple[aws.SsmCommandClient, Dict[str, Instance]]] = {}
+
+        for (account_id, region), instances in self._group_by_account_and_region().items():
+            command_client = aws.SsmCommandClient(aws.create_client('ssm', region,
+                                                                    self._account_sessions.get(account_id)))
+            instances_by_id = {instance.instance_id: instance for instance in instances}
+
+            for instance_ids in aws.batch(list(instances_by_id), command_client.instance_ids_per_request):
+                try:
+                    command_id = command_client.send_command(instance_ids, command, self._max_concurrency,
+                                                             self._timeout_seconds)
+                except ClientError as e:
+                    for instance_id in instance_ids:
+                        self._output_printer.print_line(instances_by_id[instance_id], f"Unable to send command: {e}")
+                        results.append(CommandResult(instances_by_id[instance_id], -1, 'Undeliverable'))
+                    continue
+
+                self._logger.debug(f"Sent command {command_id} to {len(instance_ids)} instances in {region}")
+                running_commands[command_id] = (command_client, {instance_id: instances_by_id[instance_id]
+                                                                 for instance_id in instance_ids})
+
+        # Run Command times the command out itself, but it may not be able to report it, like when the instance has
+        # stopped, so sessh stops waiting shortly after
+        deadline = time.monotonic() + self._timeout_seconds + self._poll_interval_seconds
+
+        while running_commands:
+            if time.monotonic() >= deadline:
+                for _, running_instances in running_commands.values():
+                    for instance in running_instances.values():
+                        self._output_printer.print_line(instance, f"Timed out after {self._timeout_seconds}s")
+                        results.append(CommandResult(instance, -1, 'TimedOut'))
+                break
+
+            time.sleep(self._poll_interval_seconds)
+
+            for command_id, (command_client, running_instances) in list(running_commands.items()):
+                for invocation in command_client.get_finished_invocations(command_id):
+                    instance = running_instances.pop(invocation['InstanceId'], None)
+
+                    # Already printed the last time the command was checked
+                    if instance is not None:
+                        results.append(self._print_invocation(instance, invocation))
+
+                if not running_instances:
+                    del running_commands[command_id]
+
+        return results
+
+    def _group_by_account_and_region(self) -> Dict[Tuple[Optional[str], str], List[Instance]]:
+        groups = {}
+
+        for instance in self._instances:
+            groups.setdefault((instance.account_id, instance.region), []).append(instance)
+
+        return groups
+
+    def _print_invocation(self, instance: Instance, invocation: Dict) -> CommandResult:
+        plugins = invocation.get('CommandPlugins') or [{}]
+
+        for plugin in plugins:
+            for line in (plugin.get('Output') or '').splitlines():
+                self._output_printer.print_line(instance, line)
+
+        if invocation['Status'] != 'Success':
+            self._output_printer.print_line(instance, f"{invocation['Status']}: {invocation.get('StatusDetails', '')}")
+
+        return CommandResult(instance, plugins[0].get('ResponseCode', -1), invocation['Status'])
+
+
+def get_instance_label(instance: Instance) -> str:
+    return f"{instance.name} ({instance.instance_id})"
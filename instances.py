@@ -0,0 +1,256 @@
+import bisect
+import difflib
+import fnmatch
+import re
+from datetime import datetime
+from enum import Enum
+from typing import List, Optional, Dict, Tuple
+
+
+class ConnectionType(Enum):
+    SSH = 'SSH'
+    SESSION_MANAGER = 'Session Manager'
+
+
+class Route(Enum):
+    """The ways sessh can connect to an instance."""
+    SESSION_MANAGER = 'Session Manager'
+    BASTION_SSH = 'bastion'
+    DIRECT_SSH = 'public IP'
+
+
+class Instance:
+    # There can be tens of thousands of instances, so they don't each have a __dict__
+    __slots__ = ('instance_id', 'name', 'public_ip', 'private_ip', 'launch_time', 'connection_type', 'ssh_key', 'state',
+                 'region', 'account_id', 'ssm_ping_status', 'ssm_ping_age_seconds', 'route', 'bastion',
+                 'probe_seconds')
+
+    def __init__(self, instance_id: str, name: str, public_ip: Optional[str], private_ip: Optional[str],
+                 launch_time: datetime, connection_type: ConnectionType, ssh_key: Optional[str], state: str,
+                 region: str, account_id: Optional[str], ssm_ping_status: Optional[str] = None,
+                 ssm_ping_age_seconds: Optional[float] = None):
+        """
+        :param ssm_ping_status: whether the SSM agent is `Online`, `ConnectionLost` or `Inactive`, if it is managed
+        :param ssm_ping_age_seconds: how long before the instance was fetched the SSM agent last pinged SSM
+        """
+        self.instance_id = instance_id
+        self.name = name
+        self.private_ip = private_ip
+        self.public_ip = public_ip
+        self.launch_time = launch_time
+        self.connection_type = connection_type
+        self.ssh_key = ssh_key
+        self.state = state
+        self.region = region
+        self.account_id = account_id
+        self.ssm_ping_status = ssm_ping_status
+        self.ssm_ping_age_seconds = ssm_ping_age_seconds
+        # Set when connecting, once the route to the instance has been chosen
+        self.route: Optional[Route] = None
+        self.bastion: Optional[str] = None
+        """The bastion the route is via, as user@host"""
+        self.probe_seconds: Optional[Dict[str, Optional[float]]] = None
+        """
+        How long it took to open a TCP connection to each bastion, by its host, and to the public IP address, or None if
+        it couldn't be opened. Only set if they were probed.
+        """
+
+    def is_running(self) -> bool:
+        return self.state == 'running'
+
+    def supports_ssh(self) -> bool:
+        """
+        Is SSH used to connect to this instance.
+
+        Note: Does NOT check whether access would be allowed by security group configuration.
+        """
+        return self.connection_type == ConnectionType.SSH and self.ssh_key is not None
+
+    def supports_session_manager(self) -> bool:
+        return self.connection_type == ConnectionType.SESSION_MANAGER
+
+    def connection_details(self) -> str:
+        if self.route is not None:
+            return self._route_details()
+
+        if self.supports_ssh():
+            connection_type = f"SSH ({self.ssh_key})"
+        elif self.supports_session_manager():
+            connection_type = "Session Manager" if self.ssm_ping_status in (None, 'Online') \
+                else f"Session Manager ({self.ssm_ping_status})"
+        else:
+            connection_type = "Unknown"
+
+        return connection_type
+
+    def _route_details(self) -> str:
+        if self.route == Route.SESSION_MANAGER:
+            details = "Session Manager"
+        elif self.route == Route.BASTION_SSH:
+            details = f"SSH via {self.bastion.rsplit('@', 1)[-1]} ({self.ssh_key})"
+        else:
+            details = f"SSH to public IP ({self.ssh_key})"
+
+        if self.probe_seconds:
+            probes = ', '.join(f"{label} {'unreachable' if seconds is None else f'{seconds * 1000:.0f}ms'}"
+                               for label, seconds in self.probe_seconds.items())
+            details += f" [{probes}]"
+
+        return details
+
+    def to_dict(self) -> dict:
+        """Convert to a JSON serialisable dictionary so the instance can be stored in the inventory cache."""
+        return {
+            'instance_id': self.instance_id,
+            'name': self.name,
+            'public_ip': self.public_ip,
+            'private_ip': self.private_ip,
+            'launch_time': self.launch_time.isoformat(),
+            'connection_type': self.connection_type.value,
+            'ssh_key': self.ssh_key,
+            'state': self.state,
+            'region': self.region,
+            'account_id': self.account_id,
+            'ssm_ping_status': self.ssm_ping_status,
+            'ssm_ping_age_seconds': self.ssm_ping_age_seconds,
+        }
+
+    @classmethod
+    def from_dict(cls, instance: dict) -> 'Instance':
+        return cls(instance['instance_id'], instance['name'], instance['public_ip'], instance['private_ip'],
+                   datetime.fromisoformat(instance['launch_time']), ConnectionType(instance['connection_type']),
+                   instance['ssh_key'], instance['state'], instance['region'],
+                   instance['account_id'], instance.get('ssm_ping_status'), instance.get('ssm_ping_age_seconds'))
+
+
+class InstancesRepository:
+    # Characters that make an instance name a shell style pattern
+    pattern_characters = re.compile(r'[*?\[]')
+    # How similar a name has to be, from 0 to 1, to be suggested when nothing else matches
+    similarity_cutoff = 0.6
+
+    def __init__(self, instances: List[Instance], account_id: Optional[str] = None, from_cache: bool = False):
+        """
+        :param account_id: the AWS account the instances belong to, if it is known
+        :param from_cache: whether the instances were loaded from the inventory cache rather than fetched from AWS
+        """
+        # Sort list by name
+        self._instances = sorted(instances, key=lambda i: i.name.casefold())
+
+        # The account isn't always known until after the instances have been fetched
+        if account_id is not None:
+            for instance in self._instances:
+                if instance.account_id is None:
+                    instance.account_id = account_id
+        self._from_cache = from_cache
+
+        # Built the first time an instance is looked up, as most repositories are only listed
+        self._instances_by_id: Optional[Dict[str, Instance]] = None
+        self._names: Optional[List[str]] = None
+        """The case folded name of each instance, in the same order as the instances so they can be bisected"""
+
+    def all(self) -> List[Instance]:
+        return self._instances
+
+    def running(self) -> List[Instance]:
+        return [i for i in self._instances if i.is_running()]
+
+    def is_from_cache(self) -> bool:
+        return self._from_cache
+
+    def find_running_by_instance_name(self, name: str) -> List[Instance]:
+        """Find the running instances with this name, ignoring case."""
+        return self._find_running_by_name_prefix(name.casefold(), exact=True)
+
+    def find_running_by_instance_id(self, instance_id: str) -> List[Instance]:
+        self._build_indexes()
+        instance = self._instances_by_id.get(instance_id)
+
+        return [instance] if instance is not None and instance.is_running() else []
+
+    def find_running_by_instance_name_pattern(self, pattern: str) -> List[Instance]:
+        """Find the running instances with names matching a shell style pattern, e.g. api-*, ignoring case."""
+        pattern = pattern.casefold()
+        # Only the names starting with the part of the pattern before the first wildcard need to be checked
+        candidates = self._find_running_by_name_prefix(self.pattern_characters.split(pattern, 1)[0])
+
+        return [i for i in candidates if fnmatch.fnmatchcase(i.name.casefold(), pattern)]
+
+    def find_running_by_instance_name_prefix(self, prefix: str) -> List[Instance]:
+        """Find the running instances with names starting with the prefix, ignoring case, shortest names first."""
+        return sorted(self._find_running_by_name_prefix(prefix.casefold()), key=lambda i: len(i.name))
+
+    def find_running_similar_to_instance_name(self, name: str, limit: int = 10) -> List[Instance]:
+        """
+        Find the running instances with names similar to this one, most similar first. Punctuation and case are ignored,
+        so apiprd is similar to API-prd.
+
+        Every instance is compared, so this is only used when the name doesn't match any other way.
+        """
+        normalised_name = _normalise_name(name)
+        similarities = []
+
+        for instance in self.running():
+            normalised_instance_name = _normalise_name(instance.name)
+            similarity = _get_similarity(normalised_name, normalised_instance_name)
+
+            if similarity >= self.similarity_cutoff or normalised_name in normalised_instance_name:
+                similarities.append((similarity, instance))
+
+        similarities.sort(key=lambda similar_instance: similar_instance[0], reverse=True)
+
+        return [instance for _, instance in similarities[:limit]]
+
+    def find_running(self, name_or_id: str) -> List[Instance]:
+        """Find the running instances with the instance ID, or exactly matching the name or pattern."""
+        # Instance ID specified
+        if name_or_id.startswith('i-'):
+            return self.find_running_by_instance_id(name_or_id)
+
+        if self.pattern_characters.search(name_or_id):
+            return self.find_running_by_instance_name_pattern(name_or_id)
+
+        return self.find_running_by_instance_name(name_or_id)
+
+    def find_running_closest_matches(self, name: str) -> List[Instance]:
+        """
+        Find the running instances that best match a name that didn't match exactly. Names starting with it and similar
+        names are ranked together, names equal to it or starting with it first, then by how similar they are.
+        """
+        folded_name = name.casefold()
+        normalised_name = _normalise_name(name)
+        candidates = {i.instance_id: i for i in self.find_running_by_instance_name_prefix(name) +
+                      self.find_running_similar_to_instance_name(name)}
+
+        def score(instance: Instance) -> Tuple[bool, bool, float]:
+            folded_instance_name = instance.name.casefold()
+
+            return folded_instance_name == folded_name, folded_instance_name.startswith(folded_name), \
+                _get_similarity(normalised_name, _normalise_name(instance.name))
+
+        return sorted(candidates.values(), key=score, reverse=True)
+
+    def _find_running_by_name_prefix(self, prefix: str, exact: bool = False) -> List[Instance]:
+        self._build_indexes()
+        start = bisect.bisect_left(self._names, prefix)
+
+        if exact:
+            end = bisect.bisect_right(self._names, prefix, start)
+        else:
+            # Every name starting with the prefix sorts before the prefix followed by the highest character
+            end = bisect.bisect_left(self._names, prefix + '\U0010ffff', start)
+
+        return [i for i in self._instances[start:end] if i.is_running()]
+
+    def _build_indexes(self):
+        if self._names is None:
+            self._instances_by_id = {i.instance_id: i for i in self._instances}
+            self._names = [i.name.casefold() for i in self._instances]
+
+
+def _normalise_name(name: str) -> str:
+    return re.sub(r'[\W_]', '', name.casefold())
+
+
+def _get_similarity(normalised_name: str, normalised_instance_name: str) -> float:
+    return difflib.SequenceMatcher(None, normalised_name, normalised_instance_name).ratio()
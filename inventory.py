@@ -0,0 +1,321 @@
+import logging
+import os
+import subprocess
+import sys
+from functools import partial
+from typing import List, Dict, Optional, Set, Tuple, Callable
+
+import boto3
+
+import aws
+import cache
+import configuration
+import environment
+import timings
+from instances import Instance, InstancesRepository
+
+# A session for each AWS account, by account ID. The current credentials are keyed by None and use the default session.
+AccountSessions = Dict[Optional[str], Optional[boto3.Session]]
+
+
+class Inventory:
+    """Finds instances across AWS accounts and regions, using the inventory cache when possible."""
+
+    def __init__(self, user_configuration: configuration.UserConfiguration, default_region: str):
+        self._logger = logging.getLogger(__name__)
+        self._user_configuration = user_configuration
+        self._default_region = default_region
+        self._inventory_cache_refreshes: Set[Tuple[str, str]] = set()
+        """The accounts and regions whose inventory cache is being refreshed in the background"""
+        self._identity_cache = cache.IdentityCache(user_configuration.get_cache_directory())
+
+        boto3.setup_default_session(region_name=default_region)
+        timings.instrument_session(boto3.DEFAULT_SESSION)
+        aws.configure_transport(aws.Transport.from_configuration(
+            user_configuration.get_aws_transport_configuration()))
+
+    def get_account_id(self, session: Optional[boto3.Session] = None) -> str:
+        """
+        Get the AWS account the credentials belong to, usually without having to ask STS.
+
+        :param session: the session for the account, instead of the current credentials
+        """
+        return aws.get_account_id(self._identity_cache, session)
+
+    def get_regions(self, regions_argument: Optional[str], all_regions: bool) -> List[str]:
+        """Get the AWS regions chosen on the command line, or the default region if none were chosen."""
+        if all_regions:
+            # Only regions enabled for the account are included
+            return sorted(region['RegionName'] for region in aws.create_client('ec2').describe_regions()['Regions'])
+
+        if regions_argument:
+            return [region.strip() for region in regions_argument.split(',') if region.strip()]
+
+        return [self._default_region]
+
+    def get_account_sessions(self, accounts_argument: Optional[str], all_accounts: bool) -> AccountSessions:
+        """
+        Get a session for each AWS account chosen on the command line.
+
+        When no accounts were chosen only the current credentials are used. They are keyed by None because the account
+        they belong to isn't known yet.
+        """
+        if all_accounts:
+            return self.create_account_sessions(self._user_configuration.get_account_ids())
+
+        if accounts_argument:
+            return self.create_account_sessions([self._user_configuration.get_account_id_for_alias(alias.strip())
+                                                 for alias in accounts_argument.split(',') if alias.strip()])
+
+        return {None: None}
+
+    def create_account_sessions(self, account_ids: List[str]) -> AccountSessions:
+        """
+        Create a session for each account using its configured role or named profile. Accounts without either can only
+        be used if the current credentials belong to them.
+        """
+        sessions = {}
+        assume_role_tasks = {}
+        current_account_id = None
+        sts_client = aws.create_client('sts')
+
+        for account_id in account_ids:
+            account_configuration = self._user_configuration.get_account_configuration(account_id)
+
+            if account_configuration.get('profile'):
+                sessions[account_id] = boto3.Session(profile_name=account_configuration['profile'],
+                                                     region_name=self._default_region)
+                timings.instrument_session(sessions[account_id])
+            elif account_configuration.get('role_arn'):
+                assume_role_tasks[account_id] = partial(sts_client.assume_role,
+                                                        RoleArn=account_configuration['role_arn'],
+                                                        RoleSessionName='sessh')
+            else:
+                if current_account_id is None:
+                    current_account_id = self.get_account_id()
+
+                if account_id == current_account_id:
+                    sessions[account_id] = None
+                else:
+                    print(f"There is no role_arn or profile configured for {account_configuration['alias']} "
+                          f"({account_id}) so its instances are not included. Add one to "
+                          f"GENERAL['aws']['accounts']['{account_id}'] in {self._user_configuration.get_file_path()}",
+                          file=sys.stderr)
+
+        for account_id, assumed_role in aws.run_concurrently("account credentials", assume_role_tasks).items():
+            credentials = assumed_role['Credentials']
+            sessions[account_id] = boto3.Session(aws_access_key_id=credentials['AccessKeyId'],
+                                                 aws_secret_access_key=credentials['SecretAccessKey'],
+                                                 aws_session_token=credentials['SessionToken'],
+                                                 region_name=self._default_region)
+            timings.instrument_session(sessions[account_id])
+
+        return sessions
+
+    def load_instances_for_accounts(self, refresh: bool, regions: List[str], account_sessions: AccountSessions,
+                                    on_instances: Optional[Callable[[List[Instance]], None]] = None) \
+            -> InstancesRepository:
+        """
+        Get every instance in the regions for each account, fetching a number of accounts at the same time.
+
+        :param on_instances: called with the running instances as soon as each page of them has been loaded. It is
+        called from more than one thread at the same time.
+        """
+        results = aws.run_concurrently("accounts", {
+            account_id: partial(self.load_instances, refresh, regions, session, account_id, on_instances)
+            for account_id, session in account_sessions.items()
+        }, self._user_configuration.get_max_concurrent_accounts())
+
+        return InstancesRepository([instance for instances in results.values() for instance in instances.all()],
+                                   from_cache=any(instances.is_from_cache() for instances in results.values()))
+
+    def lookup_running_instances_for_accounts(self, name_or_id: str, refresh: bool, regions: List[str],
+                                              account_sessions: AccountSessions) -> InstancesRepository:
+        """Get the running instances matching the instance name or ID in the regions for each account."""
+        results = aws.run_concurrently(f"accounts matching {name_or_id}", {
+            account_id: partial(self.lookup_running_instances, name_or_id, refresh, regions, session, account_id)
+            for account_id, session in account_sessions.items()
+        }, self._user_configuration.get_max_concurrent_accounts())
+
+        return InstancesRepository([instance for instances in results.values() for instance in instances.all()],
+                                   from_cache=any(instances.is_from_cache() for instances in results.values()))
+
+    def load_instances(self, refresh: bool, regions: List[str], session: Optional[boto3.Session] = None,
+                       account_id: Optional[str] = None,
+                       on_instances: Optional[Callable[[List[Instance]], None]] = None) -> InstancesRepository:
+        """
+        Get every instance for an AWS account in the regions, from the inventory cache when possible.
+
+        The regions that aren't cached are fetched from AWS at the same time.
+
+        :param refresh: ignore the inventory cache and fetch the instances from AWS
+        :param session: the session for the account, instead of the current credentials
+        :param account_id: the account the session belongs to, if it is already known
+        :param on_instances: called with the running instances as soon as each page of them has been loaded
+        """
+        cache_enabled = self._user_configuration.get_inventory_cache_configuration()['enabled']
+        # The cache is kept per account. The account usually comes from the identity cache without asking STS.
+        if account_id is None:
+            account_id = self.get_account_id(session)
+
+        instances = []
+        fetch_tasks = {}
+        stale_regions = []
+
+        for region in regions:
+            cached_instances = None
+            if cache_enabled and not refresh:
+                cached_instances = self.load_cached_instances(self._get_inventory_cache(account_id, region),
+                                                              account_id, stale_regions)
+
+            if cached_instances is not None:
+                instances.extend(cached_instances.all())
+
+                if on_instances is not None:
+                    on_instances(cached_instances.running())
+            elif cache_enabled:
+                fetch_tasks[region] = partial(fetch_and_cache_instances,
+                                              aws.InstanceMetadataFetcher(region, session, account_id),
+                                              self._get_inventory_cache(account_id, region), on_instances)
+            else:
+                fetch_tasks[region] = partial(aws.InstanceMetadataFetcher(region, session, account_id).fetch,
+                                              on_instances)
+
+        self.refresh_inventory_caches_in_background(account_id, stale_regions, session)
+
+        for fetched_instances in aws.run_concurrently("instances", fetch_tasks).values():
+            instances.extend(fetched_instances.all())
+
+        # Any instances from the cache need to be checked before connecting to them, even if other regions were fetched
+        return InstancesRepository(instances, account_id, from_cache=len(fetch_tasks) < len(regions))
+
+    def lookup_running_instances(self, name_or_id: str, refresh: bool, regions: List[str],
+                                 session: Optional[boto3.Session] = None,
+                                 account_id: Optional[str] = None) -> InstancesRepository:
+        """
+        Get the running instances for an AWS account in the regions, matching the instance name or ID.
+
+        The inventory cache is checked first. If the instances aren't in the cache, only the matching instances are
+        fetched from AWS so the lookup takes the same time however many instances there are.
+
+        :param refresh: ignore the inventory cache and fetch the instances from AWS
+        :param session: the session for the account, instead of the current credentials
+        :param account_id: the account the session belongs to, if it is already known
+        """
+        cache_enabled = self._user_configuration.get_inventory_cache_configuration()['enabled']
+        matching_instances = []
+        uncached_regions = list(regions)
+        lookup_tasks = {}
+        stale_regions = []
+
+        if account_id is None:
+            account_id = self.get_account_id(session)
+
+        if cache_enabled and not refresh:
+            for region in regions:
+                cached_instances = self.load_cached_instances(self._get_inventory_cache(account_id, region),
+                                                              account_id, stale_regions)
+
+                if cached_instances is not None:
+                    matching_instances.extend(cached_instances.find_running(name_or_id))
+                    uncached_regions.remove(region)
+
+            if not matching_instances:
+                self._logger.debug(f"{name_or_id} is not in the inventory cache for {account_id} so looking it up in "
+                                   f"AWS")
+                uncached_regions = list(regions)
+
+        for region in uncached_regions:
+            fetcher = aws.InstanceMetadataFetcher(region, session, account_id)
+
+            # Instance ID specified
+            if name_or_id.startswith('i-'):
+                lookup_tasks[region] = partial(fetcher.fetch_running_by_instance_id, name_or_id)
+            else:
+                lookup_tasks[region] = partial(fetcher.fetch_running_by_instance_name, name_or_id)
+
+        results = aws.run_concurrently(f"instances matching {name_or_id}", lookup_tasks)
+
+        for region, instances in results.items():
+            # The cache is missing these instances, so bring it up to date for next time
+            if cache_enabled and instances.running() and region not in stale_regions:
+                stale_regions.append(region)
+
+            matching_instances.extend(instances.running())
+
+        self.refresh_inventory_caches_in_background(account_id, stale_regions, session)
+
+        # Any instances from the cache need to be checked before connecting to them
+        return InstancesRepository(matching_instances, account_id, from_cache=len(uncached_regions) < len(regions))
+
+    def load_cached_instances(self, inventory_cache: cache.InventoryCache, account_id: str,
+                              stale_regions: List[str]) -> Optional[InstancesRepository]:
+        """
+        Get the instances from the inventory cache, if it is recent enough to be used.
+
+        A stale inventory is still used, but it is refreshed in the background so the next command sees any changes.
+
+        :param stale_regions: the region is added to these if its inventory is stale, so the account's stale regions
+        can be refreshed together
+        """
+        cached_inventory = inventory_cache.load()
+
+        if cached_inventory is None or not cached_inventory.is_usable():
+            return None
+
+        instances = [Instance.from_dict(instance) for instance in cached_inventory.instances]
+
+        if not cached_inventory.is_fresh():
+            self._logger.debug(f"The inventory cache for {account_id} in {inventory_cache.region} is stale so it will "
+                               f"be refreshed in the background")
+            stale_regions.append(inventory_cache.region)
+
+        return InstancesRepository(instances, account_id, from_cache=True)
+
+    def refresh_inventory_caches_in_background(self, account_id: str, regions: List[str],
+                                               session: Optional[boto3.Session] = None):
+        """
+        Refresh the inventory caches for the account's regions in a separate process, so sessh doesn't make the user
+        wait for it and can still be replaced by the session straight away. Every region is refreshed by the same
+        process, so there is at most one for each account. Each account and region is only refreshed once per command.
+        """
+        regions = [region for region in regions if (account_id, region) not in self._inventory_cache_refreshes]
+
+        if not regions:
+            return
+
+        self._inventory_cache_refreshes.update((account_id, region) for region in regions)
+        command = environment.get_sessh_command() + [environment.REFRESH_INVENTORY_CACHE_COMMAND, account_id] + regions
+        self._logger.debug(f"Refreshing the inventory caches for {account_id} in {', '.join(regions)} in the "
+                           f"background using {command}")
+
+        # The process is given the credentials for the account, and its own session so it outlives sessh
+        subprocess.Popen(command, env={**os.environ, **(aws.get_credentials_environment(session) or {})},
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+
+    def refresh_inventory_caches(self, account_id: str, regions: List[str]):
+        """
+        Fetch the instances in the regions for the account the current credentials belong to, and save them to the
+        cache. The regions are fetched at the same time.
+        """
+        aws.run_concurrently("inventory caches", {
+            region: partial(fetch_and_cache_instances, aws.InstanceMetadataFetcher(region, None, account_id),
+                            self._get_inventory_cache(account_id, region))
+            for region in regions
+        })
+
+    def _get_inventory_cache(self, account_id: str, region: str) -> cache.InventoryCache:
+        cache_configuration = self._user_configuration.get_inventory_cache_configuration()
+
+        return cache.InventoryCache(self._user_configuration.get_cache_directory(), account_id, region,
+                                    cache_configuration['ttl_seconds'], cache_configuration['max_stale_seconds'])
+
+
+def fetch_and_cache_instances(fetcher: aws.InstanceMetadataFetcher, inventory_cache: cache.InventoryCache,
+                              on_instances: Optional[Callable[[List[Instance]], None]] = None) -> InstancesRepository:
+    instances = fetcher.fetch(on_instances)
+    inventory_cache.save([instance.to_dict() for instance in instances.all()])
+
+    return instances
+
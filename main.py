@@ -4,332 +4,391 @@ import argparse
 import logging
 import os
 import platform
-import shutil
 import sys
-from datetime import datetime
-from enum import Enum
-from typing import List, Dict, Optional, Generator
-
-import boto3
-import texttable as tt
+import time
+from functools import lru_cache, partial
+from typing import List, Optional, Callable, Dict, Tuple, TYPE_CHECKING
 
+import cache
 import configuration
 import connector
+import daemon_client
 import environment
+import timings
 from __init__ import __version__
+from instances import Instance, InstancesRepository, Route
 
-environment_checker = environment.Checker()
-user_configuration = configuration.UserConfiguration(environment_checker)
+if TYPE_CHECKING:
+    import executor
+    import inventory
+    import routing
 
-aws_region = os.environ.get('AWS_DEFAULT_REGION', user_configuration.get_default_region())
 
+@lru_cache(maxsize=None)
+def get_environment_checker() -> environment.Checker:
+    return environment.Checker()
 
-class ConnectionType(Enum):
-    SSH = 'SSH'
-    SESSION_MANAGER = 'Session Manager'
 
+@lru_cache(maxsize=None)
+def get_user_configuration() -> configuration.UserConfiguration:
+    return configuration.UserConfiguration(get_environment_checker())
 
-class Instance:
-    def __init__(self, instance_id: str, name: str, public_ip: Optional[str], private_ip: Optional[str],
-                 launch_time: datetime, connection_type: ConnectionType, ssh_key: Optional[str], state: str):
-        self.instance_id = instance_id
-        self.name = name
-        self.private_ip = private_ip
-        self.public_ip = public_ip
-        self.launch_time = launch_time
-        self.connection_type = connection_type
-        self.ssh_key = ssh_key
-        self.state = state
 
-    def is_running(self) -> bool:
-        return self.state == 'running'
+@lru_cache(maxsize=None)
+def get_tool_finder() -> environment.ToolFinder:
+    return environment.ToolFinder(cache.ToolCache(get_user_configuration().get_cache_directory()))
 
-    def supports_ssh(self) -> bool:
-        """
-        Is SSH used to connect to this instance.
 
-        Note: Does NOT check whether access would be allowed by security group configuration.
-        """
-        return self.connection_type == ConnectionType.SSH and self.ssh_key is not None
+def get_ssh_control_masters() -> Optional[connector.SshControlMasters]:
+    user_configuration = get_user_configuration()
 
-    def supports_session_manager(self) -> bool:
-        return self.connection_type == ConnectionType.SESSION_MANAGER
+    # OpenSSH on Windows doesn't support sharing connections
+    if get_environment_checker().running_on_windows() or \
+            not user_configuration.get_ssh_multiplexing_configuration()['enabled']:
+        return None
 
-    def connection_details(self) -> str:
-        if self.supports_ssh():
-            connection_type = f"SSH ({self.ssh_key})"
-        elif self.supports_session_manager():
-            connection_type = "Session Manager"
-        else:
-            connection_type = "Unknown"
+    return connector.SshControlMasters(user_configuration.get_ssh_control_directory(),
+                                       user_configuration.get_ssh_multiplexing_configuration()['persist_seconds'])
 
-        return connection_type
 
+@lru_cache(maxsize=None)
+def get_connection_router() -> 'routing.ConnectionRouter':
+    import routing
 
-class InstancesRepository:
-    def __init__(self):
-        self._ec2_metadata = Ec2MetadataClient()
-        self._ssm_metadata = SsmMetadataClient()
-        self._instances = self._fetch_instance_metadata()
+    routing_configuration = get_user_configuration().get_routing_configuration()
+    latency_cache = cache.LatencyCache(get_user_configuration().get_cache_directory(),
+                                       routing_configuration['bastion_latency_cache_seconds'])
 
-    def running(self) -> List[Instance]:
-        return [i for i in self._instances if i.is_running()]
+    return routing.ConnectionRouter(routing_configuration['enabled'], routing_configuration['max_ssm_ping_age_seconds'],
+                                    routing_configuration['probe_timeout_seconds'], latency_cache)
 
-    def _fetch_instance_metadata(self) -> List[Instance]:
-        # Sort list by name
-        return sorted(self._merge_instance_metadata(), key=lambda i: i.name.casefold())
 
-    def _merge_instance_metadata(self) -> Generator[Instance, None, None]:
-        for instance_metadata in self._ec2_metadata.running():
-            ssm_metadata = self._ssm_metadata.by_id(instance_metadata.instance_id)
+def get_daemon_client() -> Optional[daemon_client.DaemonClient]:
+    """Get a client for `sessh daemon`, unless it is disabled. Its requests return None if it isn't running."""
+    if not daemon_client.is_supported() or not get_user_configuration().get_daemon_configuration()['enabled']:
+        return None
 
-            if ssm_metadata:
-                connection_type = ConnectionType.SESSION_MANAGER
-            else:
-                connection_type = ConnectionType.SSH
+    return daemon_client.DaemonClient(get_user_configuration().get_daemon_socket_path(), get_aws_region())
 
-            yield Instance(instance_metadata.instance_id, instance_metadata.get_name(), instance_metadata.public_ip,
-                           instance_metadata.private_ip, instance_metadata.launch_time, connection_type,
-                           instance_metadata.ssh_key_name, instance_metadata.state)
 
-    def find_running_by_instance_name(self, name: str) -> List[Instance]:
-        return [i for i in self._instances if i.name == name and i.is_running()]
+def get_aws_region() -> str:
+    return os.environ.get('AWS_DEFAULT_REGION', get_user_configuration().get_default_region())
 
-    def find_running_by_instance_id(self, instance_id: str) -> List[Instance]:
-        return [i for i in self._instances if i.instance_id == instance_id and i.is_running()]
 
+def create_inventory() -> 'inventory.Inventory':
+    # boto3 takes a long time to import so it is only imported by the commands that talk to AWS, and not for things
+    # like --help and --version
+    with timings.span('import boto3'):
+        import inventory
 
-class Ec2InstanceMetadata:
-    def __init__(self, instance_id: str, public_ip: Optional[str], private_ip: Optional[str], state: str,
-                 launch_time: datetime, ssh_key_name, tags: List[Dict[str, str]]):
-        self.instance_id = instance_id
-        self.private_ip = private_ip
-        self.public_ip = public_ip
-        self.state = state
-        self.launch_time = launch_time
-        self.ssh_key_name = ssh_key_name
-        self._tags = tags
+    with timings.span('create inventory'):
+        return inventory.Inventory(get_user_configuration(), get_aws_region())
 
-    def is_running(self) -> bool:
-        return self.state == 'running'
 
-    def get_name(self) -> str:
-        """Get the instance name based on the tag with the key "Name"."""
-        for tag in self._tags:
-            if tag['Key'] == 'Name':
-                return tag['Value']
+def get_table_headings(regions: List[str], number_accounts: int) -> dict:
+    table_headings = get_user_configuration().get_table_configuration()
 
-        return "-No name set-"
+    # Instances with the same name could be in different regions or accounts, so make sure they can be told apart
+    if number_accounts > 1:
+        table_headings = {**table_headings, 'Account': True}
 
+    if len(regions) > 1:
+        table_headings = {**table_headings, 'Region': True}
 
-class Ec2MetadataClient:
-    def __init__(self):
-        self._client = boto3.client('ec2')
-        self._instances = self._fetch_metadata()
+    return table_headings
 
-    def all(self) -> Generator[Ec2InstanceMetadata, None, None]:
-        return self._instances
 
-    def running(self) -> List[Ec2InstanceMetadata]:
-        return [i for i in self._instances if i.is_running()]
+def list_instances(instances_inventory: 'inventory.Inventory', refresh: bool, regions: List[str],
+                   account_sessions: 'inventory.AccountSessions', output_format: str) -> int:
+    import display
 
-    def _fetch_metadata(self) -> Generator[Ec2InstanceMetadata, None, None]:
-        paginator = self._client.get_paginator('describe_instances')
-        page_iterator = paginator.paginate()
+    displayer = display.InstancesDisplayer(get_table_headings(regions, len(account_sessions)),
+                                           get_user_configuration().get_account_aliases(),
+                                           get_user_configuration().get_table_renderer())
 
-        for page in page_iterator:
-            for reservations in page['Reservations']:
-                for instance in reservations['Instances']:
-                    yield Ec2InstanceMetadata(
-                        instance['InstanceId'],
-                        instance.get('PublicIpAddress'),
-                        instance.get('PrivateIpAddress'),
-                        instance['State']['Name'],
-                        instance['LaunchTime'],
-                        instance.get('KeyName'),
-                        instance.get('Tags', {})
-                    )
+    if output_format == 'table':
+        with timings.span('load instances'):
+            instances = instances_inventory.load_instances_for_accounts(refresh, regions, account_sessions)
 
+        with timings.span('draw table'):
+            displayer.display(instances.running())
 
-class SsmMetadataClient:
-    def __init__(self):
-        self._client = boto3.client('ssm')
-        self._instances = self._fetch_metadata()
+        return 0
 
-    def all(self) -> Dict[str, Dict]:
-        return self._instances
+    # Every other format is written as the instances are fetched, in the order they arrive
+    writer = display.create_instances_writer(output_format, displayer)
+    with timings.span('load and write instances'):
+        instances_inventory.load_instances_for_accounts(refresh, regions, account_sessions, writer.write)
+        writer.close()
 
-    def by_id(self, instance_id) -> Optional[Dict]:
-        if instance_id not in self._instances:
-            return None
+    return 0
 
-        return self._instances[instance_id]
 
-    def _fetch_metadata(self) -> Dict[str, Dict]:
-        paginator = self._client.get_paginator('describe_instance_information')
-        page_iterator = paginator.paginate()
+def list_instances_using_daemon(sessh_daemon: daemon_client.DaemonClient, scope: dict,
+                                output_format: str) -> Optional[int]:
+    """
+    List the instances `sessh daemon` has in memory.
 
-        metadata = {}
+    :param scope: the regions and accounts to list the instances in, and whether to refresh them
+    :return: the exit code, or None if the daemon isn't running
+    """
+    import display
 
-        for page in page_iterator:
-            for instance_info in page['InstanceInformationList']:
-                instance_id = instance_info['InstanceId']
-                metadata[instance_id] = instance_info
+    response = sessh_daemon.request({'action': 'list', **scope})
+    if response is None:
+        return None
 
-        return metadata
+    instances = [Instance.from_dict(instance) for instance in response['instances']]
+    displayer = display.InstancesDisplayer(get_table_headings(response['regions'], response['number_accounts']),
+                                           get_user_configuration().get_account_aliases(),
+                                           get_user_configuration().get_table_renderer())
 
+    if output_format == 'table':
+        displayer.display(instances)
+        return 0
 
-class InstancesDisplayer:
-    header_mappings = {
-        'Name': lambda i: i.name,
-        'Instance ID': lambda i: i.instance_id,
-        'Launch time': lambda i: i.launch_time,
-        'Private IP': lambda i: i.private_ip,
-        'Public IP': lambda i: i.public_ip,
-        'Connection type': lambda i: i.connection_details(),
-    }
-    """Maps the table column heading to a lambda that returns the relevant value from the Instance"""
+    writer = display.create_instances_writer(output_format, displayer)
+    writer.write(instances)
+    writer.close()
+
+    return 0
 
-    def __init__(self, table_column_configuration: dict):
-        self._table_column_configuration = table_column_configuration
 
-    def display(self, instances: List[Instance]):
-        table = self._start_table()
+def choose_instance(instances: List[Instance], regions: List[str], number_accounts: int) -> Instance:
+    import display
 
-        table.header(self.get_chosen_headers())
+    displayer = display.InstancesDisplayer(get_table_headings(regions, number_accounts),
+                                           get_user_configuration().get_account_aliases(),
+                                           get_user_configuration().get_table_renderer())
 
-        for instance in instances:
-            table.add_row(self.get_instance_details(self.get_chosen_headers(), instance))
+    while True:
+        displayer.display_indexed(instances)
 
-        print(table.draw())
+        # Pick first instance as the default
+        with timings.span('wait for choice'):
+            choice = input('Select an instance to connect to [0]: ') or 0
+
+        try:
+            return instances[int(choice)]
+        except (IndexError, ValueError):
+            pass
 
-    def _start_table(self) -> tt.Texttable:
-        # Make the table at least 120 columns wide, but bigger if the terminal is currently wider.
-        terminal_columns = shutil.get_terminal_size().columns
-        table_width = max(terminal_columns, 120)
-        table = tt.Texttable(table_width)
 
-        return table
+def connect_to_instance(instances_inventory: 'inventory.Inventory', name_or_id: str,
+                        connect_to_public_ip_address: bool, refresh: bool, regions: List[str],
+                        account_sessions: 'inventory.AccountSessions',
+                        speculative_bastion: Optional[connector.SpeculativeSshMaster] = None) -> int:
+    """
+    :param speculative_bastion: the connection to the bastion already being started, rather than starting one
+    """
+    import aws
+
+    logger = logging.getLogger(__name__)
+
+    if speculative_bastion is None and not connect_to_public_ip_address:
+        speculative_bastion = connect_to_bastion_speculatively(instances_inventory, account_sessions)
+
+    with timings.span('look up instance', name_or_id=name_or_id):
+        instances = instances_inventory.lookup_running_instances_for_accounts(name_or_id, refresh, regions,
+                                                                              account_sessions)
+    matching_instances = instances.running()
+
+    if not matching_instances:
+        # Search every instance instead, which is quick when they are in the inventory cache. Instances looked up in AWS
+        # are filtered by their Name tag, which is case sensitive, unlike matching them in sessh.
+        with timings.span('load instances', name_or_id=name_or_id):
+            instances = instances_inventory.load_instances_for_accounts(refresh, regions, account_sessions)
+            matching_instances = instances.find_running(name_or_id)
+
+    if not matching_instances:
+        # Suggest names like it instead
+        with timings.span('find similar instances', name_or_id=name_or_id):
+            closest_matches = instances.find_running_closest_matches(name_or_id)
+
+        if not closest_matches:
+            print(f"There are no running instances for {name_or_id}.")
+            drop_speculative_bastion(speculative_bastion)
+            return 1
+
+        print(f"There are no running instances for {name_or_id}, but there are some with similar names.")
+        # Always ask, so sessh doesn't connect to an instance with a different name without checking first
+        matching_instance = choose_instance(closest_matches, regions, len(account_sessions))
+    elif len(matching_instances) == 1:
+        matching_instance = matching_instances[0]
+    else:
+        print(f"There are {len(matching_instances)} running instances matching {name_or_id}.")
+        matching_instance = choose_instance(matching_instances, regions, len(account_sessions))
 
-    def get_chosen_headers(self) -> List[str]:
-        """Get the headers that have been chosen by the user in the configuration file."""
-        chosen_headers = []
+    # Sessions for the current credentials are keyed by None
+    session = account_sessions.get(matching_instance.account_id)
 
-        for header, is_chosen in self._table_column_configuration.items():
-            if is_chosen:
-                chosen_headers.append(header)
+    if instances.is_from_cache():
+        with timings.span('check instance is running', instance_id=matching_instance.instance_id):
+            metadata = aws.get_running_instance_metadata(matching_instance.instance_id, matching_instance.region,
+                                                         session)
 
-        return chosen_headers
+        if metadata is None:
+            logger.debug(f"{matching_instance.instance_id} from the inventory cache is no longer running so looking "
+                         f"up {name_or_id} in AWS")
+            return connect_to_instance(instances_inventory, name_or_id, connect_to_public_ip_address, True, regions,
+                                       account_sessions, speculative_bastion)
 
-    def get_instance_details(self, chosen_headers: List[str], instance: Instance) -> List[str]:
-        instance_details = []
+        # The IP addresses change when the instance is stopped and started again, or an Elastic IP is moved to it
+        matching_instance.public_ip = metadata.public_ip
+        matching_instance.private_ip = metadata.private_ip
 
-        for header_name in chosen_headers:
-            instance_details.append(self.get_instance_value_for_header(header_name, instance))
+    return start_session(matching_instance, connect_to_public_ip_address,
+                         partial(aws.get_credentials_environment, session),
+                         partial(aws.start_session, matching_instance.instance_id, matching_instance.region, session),
+                         speculative_bastion)
 
-        return instance_details
 
-    def get_instance_value_for_header(self, header_name, instance: Instance) -> Optional[str]:
-        return self.header_mappings[header_name](instance)
+def connect_to_bastion_speculatively(instances_inventory: 'inventory.Inventory',
+                                     account_sessions: 'inventory.AccountSessions') \
+        -> Optional[connector.SpeculativeSshMaster]:
+    """
+    Start connecting to the bastion for the account while the instance is looked up, in case the instance is connected
+    to via the bastion. Only done when the instance can only be in one account, so the bastion is known.
+    """
+    control_masters = get_ssh_control_masters()
 
-    def display_indexed(self, instances: List[Instance]):
-        table = self._start_table()
+    if control_masters is None or len(account_sessions) != 1 or \
+            not get_user_configuration().get_ssh_multiplexing_configuration()['speculative']:
+        return None
 
-        # Add a # as the first column so a user can choose the instance they want to connect to
-        headers = ['#']
-        headers.extend(self.get_chosen_headers())
-        table.header(headers)
+    account_id, session = next(iter(account_sessions.items()))
 
-        for index, instance in enumerate(instances):
-            instance_index = str(index)
-            instance_details = [instance_index]
-            instance_details.extend(self.get_instance_details(self.get_chosen_headers(), instance))
-            table.add_row(instance_details)
+    def get_bastion() -> Optional[Tuple[str, Optional[List[str]]]]:
+        # Sessions for the current credentials are keyed by None
+        bastion_account_id = account_id or instances_inventory.get_account_id(session)
 
-        print(table.draw())
+        try:
+            bastion_connections = get_user_configuration().get_bastion_connections_for_account_id(bastion_account_id)
+        except RuntimeError:
+            return None
 
+        return get_connection_router().choose_bastion(bastion_connections), \
+            get_user_configuration().get_ssh_key_paths_for_account_id(bastion_account_id)
 
-def list_instances() -> int:
-    instances = InstancesRepository().running()
-    InstancesDisplayer(user_configuration.configuration.GENERAL['list']['table_headings']).display(instances)
+    return connector.SpeculativeSshMaster(control_masters, get_bastion)
 
-    return 0
 
+def drop_speculative_bastion(speculative_bastion: Optional[connector.SpeculativeSshMaster]):
+    if speculative_bastion is not None:
+        speculative_bastion.drop()
 
-def choose_instance(instances: List[Instance]) -> Instance:
-    displayer = InstancesDisplayer(user_configuration.get_table_configuration())
 
-    while True:
-        displayer.display_indexed(instances)
+def connect_to_instance_using_daemon(sessh_daemon: daemon_client.DaemonClient, name_or_id: str,
+                                     connect_to_public_ip_address: bool, scope: dict) -> Optional[int]:
+    """
+    Connect to an instance `sessh daemon` has in memory.
 
-        # Pick first instance as the default
-        choice = input('Select an instance to connect to [0]: ') or 0
+    :param scope: the regions and accounts to look for the instance in
+    :return: the exit code, or None if the daemon isn't running or doesn't have a running instance matching the name or
+    ID, so it has to be looked up in AWS instead
+    """
+    with timings.span('look up instance using daemon', name_or_id=name_or_id):
+        response = sessh_daemon.request({'action': 'lookup', 'name_or_id': name_or_id, **scope})
 
-        try:
-            return instances[int(choice)]
-        except (IndexError, ValueError):
-            pass
+    if response is None or not response['instances']:
+        return None
 
+    matching_instances = [Instance.from_dict(instance) for instance in response['instances']]
 
-class AccountMetadataClient(object):
-    def __init__(self):
-        self._client = boto3.client('sts')
-        self._metadata = self._fetch_metadata()
+    if len(matching_instances) == 1:
+        matching_instance = matching_instances[0]
+    else:
+        print(f"There are {len(matching_instances)} running instances matching {name_or_id}.")
+        matching_instance = choose_instance(matching_instances, response['regions'], response['number_accounts'])
 
-    def get_account_id(self) -> str:
-        return self._metadata['Account']
+    # The daemon's instances could be up to a refresh old
+    with timings.span('check instance is running', instance_id=matching_instance.instance_id):
+        check = sessh_daemon.request({'action': 'check', 'instance': matching_instance.to_dict()})
 
-    def _fetch_metadata(self) -> Dict[str, str]:
-        return self._client.get_caller_identity()
+    if check is None or not check['running']:
+        return None
 
+    matching_instance.public_ip = check['public_ip']
+    matching_instance.private_ip = check['private_ip']
 
-def connect_to_instance(name_or_id: str, connect_to_public_ip_address: bool) -> int:
-    instances = InstancesRepository()
+    def start_session_using_daemon() -> Tuple[dict, str]:
+        started_session = sessh_daemon.request({'action': 'start_session', 'instance': matching_instance.to_dict()})
 
-    # Instance ID specified
-    if name_or_id.startswith('i-'):
-        matching_instances = instances.find_running_by_instance_id(name_or_id)
-    else:
-        matching_instances = instances.find_running_by_instance_name(name_or_id)
+        if started_session is None:
+            raise RuntimeError("sessh daemon stopped before the Session Manager session could be started")
 
-    number_running_instances = len(matching_instances)
-    if number_running_instances == 0:
-        print(f"There are no running instances for {name_or_id}.")
-        return 1
+        return started_session['response'], started_session['endpoint_url']
 
-    if number_running_instances == 1:
-        matching_instance = matching_instances[0]
-    else:
-        print(f"There are {number_running_instances} running instances matching {name_or_id}.")
-        matching_instance = choose_instance(matching_instances)
+    return start_session(matching_instance, connect_to_public_ip_address, lambda: check['credentials_environment'],
+                         start_session_using_daemon)
 
-    if matching_instance.supports_ssh():
-        client = AccountMetadataClient()
-        ssh_key_paths = user_configuration.get_ssh_key_paths_for_account_id(client.get_account_id())
 
-        if connect_to_public_ip_address:
-            if matching_instance.public_ip is None:
-                print(f"Instance {matching_instance.instance_id} does not have a public IP. You could try connecting "
-                      f"to the private IP address via a bastion.")
+def start_session(matching_instance: Instance, connect_to_public_ip_address: bool,
+                  get_credentials_environment: Callable[[], Optional[Dict[str, str]]],
+                  start_session_manager_session: Callable[[], Tuple[dict, str]],
+                  speculative_bastion: Optional[connector.SpeculativeSshMaster] = None) -> int:
+    """
+    Start a session with the instance using the best route to it: Session Manager while its SSM agent is online,
+    otherwise SSH via one of the account's bastions or to its public IP address, whichever answers first. If a Session
+    Manager session can't be started, or a bastion that answered before no longer does, the next best route is tried.
 
-                return 10
+    :param get_credentials_environment: get the environment variables with the credentials for the instance's account
+    :param start_session_manager_session: start a Session Manager session in AWS, returning the response and the SSM
+    endpoint it was started with
+    :param speculative_bastion: the connection to the bastion started while the instance was looked up, which is
+    waited for if the bastion is used, and dropped otherwise
+    """
+    if matching_instance.supports_ssh() and connect_to_public_ip_address and matching_instance.public_ip is None:
+        print(f"Instance {matching_instance.instance_id} does not have a public IP. You could try connecting "
+              f"to the private IP address via a bastion.")
+        drop_speculative_bastion(speculative_bastion)
 
-            return connector.SshDirectConnector(matching_instance.public_ip, ssh_key_paths).connect()
+        return 10
 
-        else:
-            bastion_for_account = user_configuration.get_bastion_connection_details_for_account_id(client.get_account_id())
+    try:
+        bastion_connections = get_user_configuration().get_bastion_connections_for_account_id(
+            matching_instance.account_id)
+        bastion_error = None
+    except RuntimeError as e:
+        # Only a problem when there is no other way to connect to the instance
+        bastion_connections, bastion_error = [], e
+
+    failed_routes = 0
+
+    for route, bastion_connection in get_connection_router().get_routes(matching_instance, bastion_connections,
+                                                                        connect_to_public_ip_address):
+        # Only worth mentioning when sessh had a choice to make
+        if matching_instance.probe_seconds or failed_routes:
+            print(f"Connecting to {matching_instance.instance_id} using {matching_instance.connection_details()}",
+                  file=sys.stderr)
+
+        if route != Route.SESSION_MANAGER:
+            if speculative_bastion is not None:
+                # Starting another connection to the bastion at the same time would connect to it twice. A connection
+                # to a different bastion, or when connecting to the public IP address, is dropped.
+                speculative_bastion.wait(bastion_connection)
+
+            with timings.span('create connector'):
+                ssh_connector = create_ssh_connector(matching_instance, route == Route.DIRECT_SSH, bastion_connection)
+
+            return ssh_connector.connect()
+
+        drop_speculative_bastion(speculative_bastion)
 
-            return connector.SshBastionConnector(bastion_for_account, matching_instance.private_ip,
-                                                 ssh_key_paths).connect()
+        # The AWS CLI is only needed when it is used to start the session, rather than sessh
+        use_aws_cli = get_user_configuration().get_session_manager_configuration()['use_aws_cli']
 
-    if matching_instance.supports_session_manager():
-        if not environment_checker.aws_cli_tools_installed():
+        with timings.span('find tools'):
+            aws_cli_tools_installed = not use_aws_cli or get_tool_finder().aws_cli_tools_installed()
+            session_manager_plugin = get_tool_finder().find('session-manager-plugin')
+
+        if not aws_cli_tools_installed:
             print("The AWS Command Line Tools must be installed. Visit https://aws.amazon.com/cli/ for instructions.")
             print("You can also connect to the instance in your browser by visiting "
                   "https://eu-west-1.console.aws.amazon.com/systems-manager/managed-instances?region=eu-west-1")
             return 2
 
-        if not environment_checker.aws_cli_session_manager_plugin_installed():
+        if not session_manager_plugin.is_installed():
             print("The Session Manager Plugin for the AWS CLI must be installed. Visit "
                   "https://docs.aws.amazon.com/systems-manager/latest/userguide/session-manager-working-with-install-plugin.html "
                   "for instructions.")
@@ -337,16 +396,234 @@ def connect_to_instance(name_or_id: str, connect_to_public_ip_address: bool) ->
                   "https://eu-west-1.console.aws.amazon.com/systems-manager/managed-instances?region=eu-west-1")
             return 3
 
-        return connector.SessionManagerConnector(matching_instance.instance_id,
-                                                 user_configuration.get_default_region()).connect()
+        if use_aws_cli:
+            return connector.SessionManagerConnector(matching_instance.instance_id, matching_instance.region,
+                                                     get_credentials_environment()).connect()
+
+        try:
+            with timings.span('start Session Manager session'):
+                started_session = start_session_manager_session()
+        except Exception as e:
+            # Like when the SSM agent has lost its connection since the instance was fetched
+            print(f"Unable to start a Session Manager session with {matching_instance.instance_id}: {e}",
+                  file=sys.stderr)
+            failed_routes += 1
+            continue
+
+        return connector.SessionManagerConnector(matching_instance.instance_id, matching_instance.region,
+                                                 get_credentials_environment(), session_manager_plugin.path,
+                                                 lambda: started_session).connect()
+
+    drop_speculative_bastion(speculative_bastion)
+
+    if failed_routes:
+        print(f"Unable to connect to {matching_instance.instance_id} using Session Manager or SSH.")
+        return 1
+
+    if bastion_error is not None and matching_instance.supports_ssh():
+        raise bastion_error
 
     print(f"{matching_instance.instance_id} doesn't seem to support SSH or Session Manager so I can't help you, "
           f"unfortunately.")
 
+    return 1
+
+
+def create_ssh_connector(instance: Instance, connect_to_public_ip_address: bool,
+                         bastion_connection: Optional[str] = None) -> 'executor.SshConnector':
+    """
+    Get the connector for the public IP address of the instance, or the private one via one of the account's bastions.
+
+    :param bastion_connection: the bastion to connect via, rather than the fastest of the account's bastions
+    """
+    user_configuration = get_user_configuration()
+    ssh_key_paths = user_configuration.get_ssh_key_paths_for_account_id(instance.account_id)
+
+    if connect_to_public_ip_address:
+        return connector.SshDirectConnector(instance.public_ip, ssh_key_paths, get_ssh_control_masters())
+
+    if bastion_connection is None:
+        bastion_connection = get_connection_router().choose_bastion(
+            user_configuration.get_bastion_connections_for_account_id(instance.account_id))
+
+    return connector.SshBastionConnector(bastion_connection, instance.private_ip, ssh_key_paths,
+                                         get_ssh_control_masters())
+
+
+def find_instances_for_command(instances_inventory: 'inventory.Inventory', name_or_pattern: str, regions: List[str],
+                               account_sessions: 'inventory.AccountSessions') -> List[Instance]:
+    # Commands are only sent to instances that are running now, so the instances are always looked up in AWS
+    if InstancesRepository.pattern_characters.search(name_or_pattern):
+        return instances_inventory.load_instances_for_accounts(True, regions, account_sessions) \
+            .find_running_by_instance_name_pattern(name_or_pattern)
+
+    matching_instances = instances_inventory.lookup_running_instances_for_accounts(name_or_pattern, True, regions,
+                                                                                   account_sessions).running()
+    if matching_instances:
+        return matching_instances
+
+    # The Name tag filter in AWS is case sensitive, so match the name in sessh instead like connect does
+    return instances_inventory.load_instances_for_accounts(True, regions, account_sessions) \
+        .find_running(name_or_pattern)
+
+
+def run_command(instances_inventory: 'inventory.Inventory', name_or_pattern: str, command: List[str],
+                connect_to_public_ip_address: bool, max_concurrency: int, timeout_seconds: int, regions: List[str],
+                account_sessions: 'inventory.AccountSessions') -> int:
+    """
+    :param timeout_seconds: stop waiting for the command on an instance once it has been running for this long
+    """
+    import aws
+    import executor
+
+    if not command:
+        print("Add the command to run after --, e.g. sessh exec instance-name -- uptime")
+        return 2
+
+    with timings.span('find instances', name_or_pattern=name_or_pattern):
+        instances = find_instances_for_command(instances_inventory, name_or_pattern, regions, account_sessions)
+    if not instances:
+        print(f"There are no running instances for {name_or_pattern}.")
+        return 1
+
+    output_printer = executor.OutputPrinter(instances)
+    results = []
+    ssh_connectors = {}
+    session_manager_instances = []
+
+    for instance in instances:
+        # Run Command waits for an instance whose SSM agent isn't online until the command times out
+        if get_connection_router().is_session_manager_online(instance):
+            session_manager_instances.append(instance)
+        elif instance.supports_ssh() and not (connect_to_public_ip_address and instance.public_ip is None):
+            ssh_connectors[instance.instance_id] = (instance,
+                                                    create_ssh_connector(instance, connect_to_public_ip_address))
+        elif instance.supports_session_manager():
+            output_printer.print_line(instance, f"Unable to connect using Session Manager, its SSM agent is "
+                                                f"{instance.ssm_ping_status or 'not online'}")
+            results.append(executor.CommandResult(instance, -1, 'Undeliverable'))
+        else:
+            output_printer.print_line(instance, "Unable to connect using Session Manager or SSH")
+            results.append(executor.CommandResult(instance, -1, 'Unsupported'))
+
+    executors = {
+        'SSH': executor.SshCommandExecutor(ssh_connectors, output_printer, max_concurrency, timeout_seconds),
+        'Session Manager': executor.SessionManagerCommandExecutor(session_manager_instances, account_sessions,
+                                                                  output_printer, max_concurrency, timeout_seconds),
+    }
+
+    with timings.span('run command'):
+        for executor_results in aws.run_concurrently("commands", {
+            connection_type: partial(command_executor.run, ' '.join(command))
+            for connection_type, command_executor in executors.items()
+        }).values():
+            results.extend(executor_results)
+
+    print(file=sys.stderr)
+    for result in sorted(results, key=lambda r: executor.get_instance_label(r.instance).casefold()):
+        print(f"{executor.get_instance_label(result.instance)}: {result.status} (exit code {result.exit_code})",
+              file=sys.stderr)
+
+    return 0 if all(result.succeeded() for result in results) else 1
+
+
+def manage_ssh_masters(command: str) -> int:
+    control_masters = get_ssh_control_masters()
+
+    if control_masters is None:
+        print(f"SSH connections aren't shared. Enable GENERAL['ssh_multiplexing'] in "
+              f"{get_user_configuration().get_file_path()} to share them.")
+        return 1
+
+    if command == 'status':
+        masters = control_masters.status()
+
+        for destination, status in masters.items():
+            print(f"{destination}: {status or 'not responding'}")
+
+        if not masters:
+            print("There are no shared SSH connections.")
+
+    if command == 'stop':
+        for destination in control_masters.stop():
+            print(f"Stopped the shared SSH connection to {destination}")
+
+    return 0
+
+
+def manage_daemon(command: str) -> int:
+    sessh_daemon = get_daemon_client()
+
+    if sessh_daemon is None:
+        print(f"sessh daemon isn't available on this platform, or is disabled in GENERAL['daemon'] in "
+              f"{get_user_configuration().get_file_path()}")
+        return 1
+
+    if command == 'run':
+        import daemon
+
+        return daemon.InventoryDaemon(create_inventory(), get_user_configuration().get_daemon_socket_path(),
+                                      get_aws_region(),
+                                      get_user_configuration().get_daemon_configuration()['refresh_seconds']).serve()
+
+    response = sessh_daemon.request({'action': command})
+
+    if response is None:
+        print("sessh daemon is not running.")
+        return 1 if command == 'status' else 0
+
+    if command == 'status':
+        print(f"sessh daemon is running with process ID {response['pid']}, and has {response['instances']} instances "
+              f"in memory, refreshed every {response['refresh_seconds']}s:")
+        for region in response['regions']:
+            print(f"  {region}")
+
+    if command == 'stop':
+        print(f"Stopped sessh daemon with process ID {response['pid']}")
+
+    return 0
+
+
+def diagnose(refresh: bool) -> int:
+    """Check everything sessh depends on, showing how long each took so slow ones can be found."""
+    healthy = True
+
+    started = time.perf_counter()
+    try:
+        get_user_configuration().configuration
+        print_diagnosis("Configuration file", get_user_configuration().get_file_path(), started)
+    except Exception as e:
+        print_diagnosis("Configuration file", f"unable to load: {e}", started)
+        healthy = False
+
+    for tool_name in ('aws', 'session-manager-plugin', 'ssh'):
+        tool = get_tool_finder().find(tool_name, include_version=True, refresh=refresh)
+        details = f"{tool.path} ({tool.version or 'unknown version'})" if tool.is_installed() else "not found"
+        print_diagnosis(tool_name, details, time.perf_counter() - tool.resolve_seconds, tool.from_cache)
+        healthy = healthy and tool.is_installed()
+
+    started = time.perf_counter()
+    import boto3
+    print_diagnosis("boto3", boto3.__version__, started)
+
+    started = time.perf_counter()
+    try:
+        print_diagnosis("AWS account", create_inventory().get_account_id(), started)
+    except Exception as e:
+        print_diagnosis("AWS account", f"unable to find the account for your credentials: {e}", started)
+        healthy = False
+
+    return 0 if healthy else 1
+
+
+def print_diagnosis(dependency: str, details: str, started: float, from_cache: bool = False):
+    duration_ms = (time.perf_counter() - started) * 1000
+    print(f"{dependency:<24} {duration_ms:>8.1f}ms{' (cached)' if from_cache else '         '}  {details}")
+
 
 def version_information() -> int:
     print(f"sessh/{__version__} Python/{platform.python_version()}")
-    print(f"Configuration file path: {user_configuration.get_file_path()}")
+    print(f"Configuration file path: {get_user_configuration().get_file_path()}")
 
     return 0
 
@@ -354,18 +631,71 @@ def version_information() -> int:
 if __name__ == '__main__':
     common_arguments = argparse.ArgumentParser(add_help=False)
     common_arguments.add_argument('--debug', help="output debug information", action='store_true', default=False)
+    common_arguments.add_argument('--refresh', help="fetch the instances from AWS instead of the inventory cache",
+                                  action='store_true', default=False)
+    region_arguments = common_arguments.add_mutually_exclusive_group()
+    region_arguments.add_argument('--regions', help="comma separated list of AWS regions to use instead of the default "
+                                                    "region")
+    region_arguments.add_argument('--all-regions', help="use every AWS region enabled for the account",
+                                  action='store_true', default=False)
+    account_arguments = common_arguments.add_mutually_exclusive_group()
+    account_arguments.add_argument('--accounts', help="comma separated list of configured AWS account aliases to use "
+                                                      "instead of the account for the current credentials")
+    account_arguments.add_argument('--all-accounts', help="use every configured AWS account", action='store_true',
+                                   default=False)
+    common_arguments.add_argument('--timings', help="show how long each phase took, and the AWS API calls made",
+                                  action='store_true', default=False)
+    common_arguments.add_argument('--trace', help="write how long each phase and AWS API call took to a file in "
+                                                  "Chrome's trace event format", metavar='FILE')
 
     parser = argparse.ArgumentParser(description="Command line tool to help start sessions on AWS EC2 instances")
     parser.add_argument('--version', help="display version information", action='store_true', default=False)
     subparsers = parser.add_subparsers(dest='action')
     list_command = subparsers.add_parser('list', help="list running EC2 instances", parents=[common_arguments])
+    list_command.add_argument('--format', help="a table sorted by name, columns written as the instances are fetched, "
+                                               "or a machine readable format written as the instances are fetched",
+                              choices=['table', 'stream', 'json', 'ndjson', 'csv', 'tsv'], default='table')
     connect_command = subparsers.add_parser('connect', help="connect to a running EC2 instance",
                                             parents=[common_arguments])
     connect_command.add_argument('instance', help="EC2 instance ID or EC2 instance name")
     connect_command.add_argument('--public', '-p', help="connect to the public IP address instead of the private one",
                                  action='store_true', default=False)
-
-    args = parser.parse_args()
+    exec_command = subparsers.add_parser('exec', help="run a command on every running EC2 instance matching a name",
+                                         parents=[common_arguments])
+    exec_command.add_argument('instance', help="EC2 instance ID, EC2 instance name, or a pattern like api-*")
+    exec_command.add_argument('command', help="the command to run, after --", nargs='*')
+    exec_command.add_argument('--public', '-p', help="connect to the public IP address instead of the private one",
+                              action='store_true', default=False)
+    exec_command.add_argument('--max-concurrency', help="the most instances to run the command on at the same time",
+                              type=int, default=20)
+    exec_command.add_argument('--timeout', help="the most seconds to wait for the command to finish on each instance",
+                              type=int, default=600)
+    ssh_master_command = subparsers.add_parser('ssh-master', help="show or stop the SSH connections shared by sessions")
+    ssh_master_command.add_argument('command', help="show the shared connections, or stop them",
+                                    choices=['status', 'stop'])
+    ssh_master_command.add_argument('--debug', help="output debug information", action='store_true', default=False)
+    daemon_command = subparsers.add_parser('daemon', help="run a background agent that keeps the instances in memory, "
+                                                          "so list and connect don't have to load them")
+    daemon_command.add_argument('command', help="run the daemon until it is stopped, show what it has in memory, or "
+                                                "stop it", choices=['run', 'status', 'stop'])
+    daemon_command.add_argument('--debug', help="output debug information", action='store_true', default=False)
+    doctor_command = subparsers.add_parser('doctor', help="check the tools and credentials sessh needs, and how long "
+                                                          "each takes to find")
+    doctor_command.add_argument('--debug', help="output debug information", action='store_true', default=False)
+    doctor_command.add_argument('--refresh', help="find the tools again instead of using where they were found before",
+                                action='store_true', default=False)
+
+    arguments = sys.argv[1:]
+
+    # Run in a separate process by list and connect, so it can carry on after they have finished
+    if arguments[:1] == [environment.REFRESH_INVENTORY_CACHE_COMMAND]:
+        create_inventory().refresh_inventory_caches(arguments[1], arguments[2:])
+        sys.exit(0)
+
+    # Everything after -- is the command for exec to run, which can have options of its own
+    command_start = arguments.index('--') if '--' in arguments else len(arguments)
+
+    args = parser.parse_args(arguments[:command_start])
 
     try:
         if args.version:
@@ -374,18 +704,63 @@ if __name__ == '__main__':
         logging_level = logging.DEBUG if 'debug' in args and args.debug else logging.WARNING
         logging.basicConfig(level=logging_level)
 
-        boto3.setup_default_session(region_name=aws_region)
+        if 'timings' in args and (args.timings or args.trace):
+            timings.enable(args.timings, args.trace)
+
+        if args.action in ('list', 'connect') and get_daemon_client() is not None:
+            scope = {'regions': args.regions, 'all_regions': args.all_regions, 'accounts': args.accounts,
+                     'all_accounts': args.all_accounts, 'refresh': args.refresh}
+
+            if args.action == 'list':
+                exit_code = list_instances_using_daemon(get_daemon_client(), scope, args.format)
+            else:
+                # Refreshing means looking the instance up in AWS rather than in memory
+                exit_code = None if args.refresh else \
+                    connect_to_instance_using_daemon(get_daemon_client(), args.instance, args.public, scope)
+
+            if exit_code is not None:
+                sys.exit(exit_code)
 
         if args.action == 'list':
-            sys.exit(list_instances())
+            instances_inventory = create_inventory()
+            sys.exit(list_instances(instances_inventory, args.refresh,
+                                    instances_inventory.get_regions(args.regions, args.all_regions),
+                                    instances_inventory.get_account_sessions(args.accounts, args.all_accounts),
+                                    args.format))
 
         if args.action == 'connect':
-            sys.exit(connect_to_instance(args.instance, args.public))
+            instances_inventory = create_inventory()
+            sys.exit(connect_to_instance(instances_inventory, args.instance, args.public, args.refresh,
+                                         instances_inventory.get_regions(args.regions, args.all_regions),
+                                         instances_inventory.get_account_sessions(args.accounts, args.all_accounts)))
+
+        if args.action == 'exec':
+            instances_inventory = create_inventory()
+            sys.exit(run_command(instances_inventory, args.instance, args.command + arguments[command_start + 1:],
+                                 args.public, args.max_concurrency, args.timeout,
+                                 instances_inventory.get_regions(args.regions, args.all_regions),
+                                 instances_inventory.get_account_sessions(args.accounts, args.all_accounts)))
+
+        if args.action == 'ssh-master':
+            sys.exit(manage_ssh_masters(args.command))
+
+        if args.action == 'daemon':
+            sys.exit(manage_daemon(args.command))
+
+        if args.action == 'doctor':
+            sys.exit(diagnose(args.refresh))
+    except BrokenPipeError:
+        # The output was piped to a command that stopped reading it early, like head. Python would complain about
+        # flushing the rest of the output when exiting, so it is thrown away instead.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
     except Exception as e:
         if args.debug:
             raise e
 
         print(e)
         sys.exit(1)
+    finally:
+        timings.report()
 
     parser.print_help()
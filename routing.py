@@ -0,0 +1,234 @@
+import logging
+import queue
+import socket
+import threading
+import time
+from typing import Dict, Generator, Hashable, List, Optional, Set, Tuple
+
+import cache
+import timings
+from instances import Instance, Route
+
+SSH_PORT = 22
+
+
+def get_ssh_host(destination: str) -> str:
+    """Get the host from an SSH destination like user@host."""
+    return destination.rsplit('@', 1)[-1]
+
+
+def probe(host: str, port: int, timeout_seconds: float) -> Optional[float]:
+    """Get how long it takes to open a TCP connection to the host, or None if it can't be opened within the timeout."""
+    started = time.perf_counter()
+
+    try:
+        with socket.create_connection((host, port), timeout=timeout_seconds):
+            return time.perf_counter() - started
+    except OSError:
+        return None
+
+
+def probe_until_first_answer(destinations: Dict[Hashable, Tuple[str, int]],
+                             timeout_seconds: float) -> Dict[Hashable, Optional[float]]:
+    """
+    Probe every destination at the same time, and stop waiting as soon as one of them answers, so a destination that
+    doesn't answer only holds sessh up when none of them do.
+
+    :param destinations: the host and port to probe, by key
+    :return: how long each destination that was finished with took to connect to, or None if it couldn't be connected
+    to, with the same key as the destination. Destinations still being probed when the first one answered are left out.
+    """
+    results: queue.Queue = queue.Queue()
+
+    for key, (host, port) in destinations.items():
+        # The probes still running once one has answered are left to time out by themselves
+        threading.Thread(target=_probe_into, args=(results, key, host, port, timeout_seconds), name=f'probe-{key}',
+                         daemon=True).start()
+
+    latencies = {}
+    while len(latencies) < len(destinations):
+        key, seconds = results.get()
+        latencies[key] = seconds
+
+        if seconds is not None:
+            break
+
+    return latencies
+
+
+def _probe_into(results: queue.Queue, key: Hashable, host: str, port: int, timeout_seconds: float):
+    results.put((key, probe(host, port, timeout_seconds)))
+
+
+# A way to connect to an instance using SSH: the route, its bastion if it has one, and the host and port to probe
+SshDestination = Tuple[Route, Optional[str], str, int]
+
+
+class ConnectionRouter:
+    """
+    Chooses how to connect to an instance. Session Manager is used while the instance's SSM agent is online. Otherwise
+    the account's bastions and the instance's public IP address are probed at the same time, and the fastest one that
+    answers is used, so sessh doesn't wait for a session that can't start to time out.
+    """
+
+    def __init__(self, enabled: bool, max_ssm_ping_age_seconds: int, probe_timeout_seconds: float,
+                 latency_cache: Optional[cache.LatencyCache] = None):
+        """
+        :param enabled: choose the route using the SSM agent's health and the probes, rather than always using Session
+        Manager for managed instances and SSH via the fastest bastion for the others
+        :param max_ssm_ping_age_seconds: the SSM agent is treated as offline if it hadn't pinged SSM for this long when
+        the instance was fetched
+        :param latency_cache: where to keep how long each bastion took to connect to, so they aren't all probed every
+        time
+        """
+        self._logger = logging.getLogger(__name__)
+        self._enabled = enabled
+        self._max_ssm_ping_age_seconds = max_ssm_ping_age_seconds
+        self._probe_timeout_seconds = probe_timeout_seconds
+        self._latency_cache = latency_cache
+        self._chosen_bastions: Dict[Tuple[str, ...], str] = {}
+
+    def is_session_manager_online(self, instance: Instance) -> bool:
+        return instance.supports_session_manager() and instance.ssm_ping_status in (None, 'Online') and \
+            (instance.ssm_ping_age_seconds is None or instance.ssm_ping_age_seconds <= self._max_ssm_ping_age_seconds)
+
+    def get_routes(self, instance: Instance, bastion_connections: List[str],
+                   connect_to_public_ip_address: bool) -> Generator[Tuple[Route, Optional[str]], None, None]:
+        """
+        Get the routes to try, best first, each with the bastion to connect via if it is via a bastion. Each is only
+        worked out when the one before it has failed, so the routes are only probed when Session Manager can't be
+        used. The instance's route and bastion are set to each in turn.
+
+        :param bastion_connections: the bastions for the instance's account, if it has any
+        :param connect_to_public_ip_address: only use SSH to connect to the public IP address, not via a bastion
+        """
+        ssh_destinations = self._get_ssh_destinations(instance, bastion_connections, connect_to_public_ip_address)
+
+        if not self._enabled:
+            if instance.supports_session_manager():
+                yield self._choose(instance, Route.SESSION_MANAGER)
+            elif instance.supports_ssh() and ssh_destinations:
+                if connect_to_public_ip_address:
+                    yield self._choose(instance, Route.DIRECT_SSH)
+                else:
+                    # Choosing between the bastions doesn't depend on choosing the route
+                    yield self._choose(instance, Route.BASTION_SSH, self.choose_bastion(bastion_connections))
+            return
+
+        session_manager_online = self.is_session_manager_online(instance)
+        if session_manager_online:
+            yield self._choose(instance, Route.SESSION_MANAGER)
+
+        # Probing only helps when there is more than one route to choose between
+        if len(ssh_destinations) > 1 or (ssh_destinations and instance.supports_session_manager()):
+            with timings.span('probe routes', instance_id=instance.instance_id):
+                instance.probe_seconds, cached_labels = self._probe(ssh_destinations)
+        else:
+            instance.probe_seconds, cached_labels = {}, set()
+
+        reachable_labels = sorted([label for label in ssh_destinations
+                                   if instance.probe_seconds.get(label) is not None],
+                                  key=lambda label: instance.probe_seconds[label])
+        for label in reachable_labels:
+            route, bastion_connection, host, port = ssh_destinations[label]
+
+            # A bastion that answered a while ago is checked again before it is used, falling over to the next one
+            if label in cached_labels:
+                instance.probe_seconds[label] = self._probe_bastion(label, host, port)
+                if instance.probe_seconds[label] is None:
+                    continue
+
+            yield self._choose(instance, route, bastion_connection)
+
+        # The SSM agent could have reconnected since the instance was fetched
+        if instance.supports_session_manager() and not session_manager_online:
+            yield self._choose(instance, Route.SESSION_MANAGER)
+
+        # The probes can be wrong, like when a bastion is only reachable through a proxy in the SSH configuration
+        for label, (route, bastion_connection, _, _) in ssh_destinations.items():
+            if instance.probe_seconds.get(label) is None:
+                yield self._choose(instance, route, bastion_connection)
+
+    def choose_bastion(self, bastion_connections: List[str]) -> str:
+        """Choose the fastest bastion that answers, or the first one if none of them do."""
+        key = tuple(bastion_connections)
+
+        if len(bastion_connections) > 1 and key not in self._chosen_bastions:
+            destinations = _get_bastion_destinations(bastion_connections)
+            with timings.span('probe bastions'):
+                latencies, _ = self._probe(destinations)
+            reachable_labels = [label for label in destinations if latencies.get(label) is not None]
+
+            if reachable_labels:
+                self._chosen_bastions[key] = destinations[min(reachable_labels, key=latencies.get)][1]
+
+        return self._chosen_bastions.get(key, bastion_connections[0])
+
+    def _get_ssh_destinations(self, instance: Instance, bastion_connections: List[str],
+                              connect_to_public_ip_address: bool) -> Dict[str, SshDestination]:
+        """Get the ways to connect to the instance using SSH, by the label they are shown with."""
+        # SSH needs the instance to have been launched with a key pair
+        if instance.ssh_key is None:
+            return {}
+
+        destinations = {}
+
+        if instance.private_ip is not None and not connect_to_public_ip_address:
+            destinations.update(_get_bastion_destinations(bastion_connections))
+
+        if instance.public_ip is not None and (connect_to_public_ip_address or self._enabled):
+            destinations[Route.DIRECT_SSH.value] = (Route.DIRECT_SSH, None, instance.public_ip, SSH_PORT)
+
+        return destinations
+
+    def _probe(self, destinations: Dict[str, SshDestination]) -> Tuple[Dict[str, Optional[float]], Set[str]]:
+        """
+        Probe the destinations at the same time until one of them answers, except the bastions probed recently enough
+        for their latency to be in the latency cache. The fastest of those is probed along with the others, as it is
+        checked again before it is used anyway.
+
+        :return: how long each destination took to connect to, or None if it couldn't be connected to, by label, and
+        the labels of the latencies that came from the cache. Destinations that hadn't answered when the first one did
+        are left out.
+        """
+        bastion_labels = [label for label, (route, _, _, _) in destinations.items() if route == Route.BASTION_SSH]
+        cached_latencies = self._latency_cache.get(bastion_labels) if self._latency_cache else {}
+        reachable_cached_labels = [label for label, seconds in cached_latencies.items() if seconds is not None]
+        fastest_cached_label = min(reachable_cached_labels, key=cached_latencies.get) \
+            if reachable_cached_labels else None
+
+        latencies = probe_until_first_answer({label: (host, port)
+                                              for label, (_, _, host, port) in destinations.items()
+                                              if label not in cached_latencies or label == fastest_cached_label},
+                                             self._probe_timeout_seconds)
+        if self._latency_cache:
+            self._latency_cache.save({label: seconds for label, seconds in latencies.items()
+                                      if label in bastion_labels})
+
+        # The fastest cached bastion is left out if it hadn't answered, as another destination answered before it
+        labels_from_cache = set(cached_latencies) - set(latencies) - {fastest_cached_label}
+
+        return {label: latencies[label] if label in latencies else cached_latencies[label]
+                for label in destinations if label in latencies or label in labels_from_cache}, labels_from_cache
+
+    def _probe_bastion(self, label: str, host: str, port: int) -> Optional[float]:
+        seconds = probe(host, port, self._probe_timeout_seconds)
+
+        if self._latency_cache:
+            self._latency_cache.save({label: seconds})
+
+        return seconds
+
+    def _choose(self, instance: Instance, route: Route, bastion_connection: Optional[str] = None) \
+            -> Tuple[Route, Optional[str]]:
+        instance.route = route
+        instance.bastion = bastion_connection
+        self._logger.debug(f"Trying to connect to {instance.instance_id} using {instance.connection_details()}")
+
+        return route, bastion_connection
+
+
+def _get_bastion_destinations(bastion_connections: List[str]) -> Dict[str, SshDestination]:
+    # Bastions are shown, and their latencies cached, by their host
+    return {get_ssh_host(connection): (Route.BASTION_SSH, connection, get_ssh_host(connection), SSH_PORT)
+            for connection in bastion_connections}
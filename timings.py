@@ -0,0 +1,180 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Dict, Optional, TextIO, Iterator
+
+
+class Span:
+    """Something sessh did, like loading the configuration or calling an AWS API, and how long it took."""
+    __slots__ = ('name', 'category', 'thread_id', 'thread_name', 'started', 'duration', 'arguments')
+
+    def __init__(self, name: str, category: str, started: float, duration: float, arguments: Dict[str, object]):
+        thread = threading.current_thread()
+        self.name = name
+        self.category = category
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.started = started
+        self.duration = duration
+        self.arguments = arguments
+
+
+class Recorder:
+    """
+    Records spans for each phase of a command and for every AWS API call, from any thread. Nothing is recorded until it
+    is enabled, so commands only pay for timing themselves when asked to.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._spans: List[Span] = []
+        self._started = time.perf_counter()
+        self._show_summary = False
+        self._trace_file_path = None
+        self._reported = False
+
+    def enable(self, show_summary: bool, trace_file_path: Optional[str] = None):
+        """
+        :param show_summary: print a table of how long each phase took, and the AWS API calls made, when reporting
+        :param trace_file_path: write every span to this file in Chrome's trace event format when reporting
+        """
+        self.enabled = True
+        self._show_summary = show_summary
+        self._trace_file_path = trace_file_path
+
+    @contextmanager
+    def span(self, name: str, category: str = 'sessh', **arguments) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, started, time.perf_counter() - started, arguments)
+
+    def add_span(self, name: str, category: str, started: float, duration: float, arguments: Dict[str, object]):
+        with self._lock:
+            self._spans.append(Span(name, category, started, duration, arguments))
+
+    def instrument_session(self, session):
+        """
+        Record every AWS API call made by clients created from the boto3 session afterwards, including how many times
+        each was retried.
+        """
+        if not self.enabled:
+            return
+
+        session.events.register('before-call', self._on_before_call, unique_id='sessh-timings-before-call')
+        session.events.register('after-call', self._on_after_call, unique_id='sessh-timings-after-call')
+        session.events.register('after-call-error', self._on_after_call_error,
+                                unique_id='sessh-timings-after-call-error')
+
+    def report(self, output: TextIO = sys.stderr):
+        """Print the summary and write the trace file, if they were asked for. Only the first report does anything."""
+        if not self.enabled or self._reported:
+            return
+
+        self._reported = True
+
+        if self._show_summary:
+            self.print_summary(output)
+
+        if self._trace_file_path:
+            self.write_trace(self._trace_file_path)
+
+    def print_summary(self, output: TextIO):
+        # display is only imported when the summary is printed
+        from display import TableRenderer
+
+        with self._lock:
+            spans = list(self._spans)
+
+        rows = []
+        for (category, name), name_spans in _group_spans(spans).items():
+            durations = [span.duration for span in name_spans]
+            rows.append([category, name, str(len(name_spans)),
+                         str(sum(span.arguments.get('retries', 0) for span in name_spans)),
+                         f"{sum(durations) * 1000:.1f}", f"{max(durations) * 1000:.1f}"])
+
+        print(file=output)
+        TableRenderer(output).draw(['Category', 'Phase', 'Count', 'Retries', 'Total ms', 'Longest ms'], rows)
+
+        api_calls = [span for span in spans if span.category == 'aws']
+        print(f"{(time.perf_counter() - self._started) * 1000:.1f}ms in total, {len(api_calls)} AWS API calls with "
+              f"{sum(span.arguments.get('retries', 0) for span in api_calls)} retries", file=output)
+
+    def write_trace(self, file_path: str):
+        """Write the spans in Chrome's trace event format, which chrome://tracing and Perfetto can show."""
+        with self._lock:
+            spans = list(self._spans)
+
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread_id,
+                   'args': {'name': thread_name}}
+                  for thread_id, thread_name in {span.thread_id: span.thread_name for span in spans}.items()]
+        events.extend({
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': round((span.started - self._started) * 1000000),
+            'dur': round(span.duration * 1000000),
+            'pid': os.getpid(),
+            'tid': span.thread_id,
+            'args': span.arguments,
+        } for span in spans)
+
+        with open(file_path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file, default=str)
+
+    def _on_before_call(self, model, context, **kwargs):
+        context['sessh_started'] = time.perf_counter()
+
+    def _on_after_call(self, model, context, http_response=None, parsed=None, **kwargs):
+        arguments = {'retries': (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)}
+        if http_response is not None:
+            arguments['status'] = http_response.status_code
+
+        self._add_api_call_span(model, context, arguments)
+
+    def _on_after_call_error(self, model, context, exception=None, **kwargs):
+        self._add_api_call_span(model, context, {'error': type(exception).__name__})
+
+    def _add_api_call_span(self, model, context, arguments: Dict[str, object]):
+        started = context.get('sessh_started', time.perf_counter())
+        self.add_span(f"{model.service_model.service_name}.{model.name}", 'aws', started,
+                      time.perf_counter() - started, arguments)
+
+
+def _group_spans(spans: List[Span]) -> Dict[tuple, List[Span]]:
+    """Group the spans by category and name, in the order each was first started."""
+    groups = {}
+
+    for span in sorted(spans, key=lambda s: s.started):
+        groups.setdefault((span.category, span.name), []).append(span)
+
+    return groups
+
+
+_recorder = Recorder()
+
+
+def enable(show_summary: bool, trace_file_path: Optional[str] = None):
+    _recorder.enable(show_summary, trace_file_path)
+
+
+def span(name: str, category: str = 'sessh', **arguments):
+    """Record how long the code in the with block takes, if timings are enabled."""
+    return _recorder.span(name, category, **arguments)
+
+
+def instrument_session(session):
+    _recorder.instrument_session(session)
+
+
+def report():
+    _recorder.report()